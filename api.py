@@ -0,0 +1,129 @@
+"""This program includes the helpers for the JSON API.
+
+The API routes are in app.py, under /api/v1, and return the same recipes
+as the HTML pages as JSON. Clients can ask for only the fields they need
+with ?fields=recipe_name,img_url, and listings are paged with the same
+cursors as the recipes page. Routes that need a user use the same session
+as the site, and return a 401 error instead of redirecting to the login
+page if no one is logged in.
+
+Responses are gzipped for clients that accept it, and errors are returned
+as JSON: {"error": "<description>"}.
+"""
+
+
+import gzip
+from datetime import datetime
+
+from flask import Blueprint, abort, jsonify, request
+from werkzeug.exceptions import HTTPException
+
+from pagination import CARD_FIELDS, parse_cursor
+
+
+api = Blueprint("api", __name__, url_prefix="/api/v1")
+
+# Fields of a recipe that can be returned
+RECIPE_FIELDS = (
+    "recipe_name", "meal_name", "description", "ingredients", "method",
+    "recommendation", "yield", "active_time", "total_time", "img_url",
+    "created_by", "date_created", "version", "updated_at",
+)
+
+# Fields of a recipe card, returned by listings and search
+CARD_FIELD_NAMES = tuple(CARD_FIELDS)
+
+# Most recipes that can be fetched at once by id
+MAX_BULK_IDS = 100
+
+# Responses smaller than this aren't worth gzipping
+GZIP_MIN_SIZE = 500
+
+
+def parse_fields(allowed):
+    """
+    Returns the fields asked for with ?fields=, or all of allowed if none
+    were asked for. Aborts with a 400 error if a field isn't in allowed.
+    """
+
+    fields = request.args.get("fields")
+    if not fields:
+        return list(allowed)
+    fields = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in fields if field not in allowed]
+    if unknown:
+        abort(400, description="Unknown fields: {}. Fields are: {}".format(
+            ", ".join(unknown), ", ".join(allowed)))
+    return fields
+
+
+def parse_ids(ids):
+    """
+    Returns the ObjectIds in a comma separated list of ids, in order and
+    without repeats. Aborts with a 400 error if any id isn't valid or
+    there are more than MAX_BULK_IDS.
+    """
+
+    parsed = []
+    for value in (ids or "").split(","):
+        if not value.strip():
+            continue
+        recipe_id = parse_cursor(value.strip())
+        if recipe_id is None:
+            abort(400, description="Invalid id: {}".format(value))
+        if recipe_id not in parsed:
+            parsed.append(recipe_id)
+    if not parsed:
+        abort(400, description="No ids given")
+    if len(parsed) > MAX_BULK_IDS:
+        abort(400, description="At most {} ids can be fetched at once"
+              .format(MAX_BULK_IDS))
+    return parsed
+
+
+def recipe_json(recipe, fields):
+    """
+    Returns the given fields of a recipe, and its id, ready to be sent as
+    JSON. Times are sent in ISO 8601 format, in UTC.
+    """
+
+    data = {"id": str(recipe["_id"])}
+    for field in fields:
+        value = recipe.get(field)
+        if isinstance(value, datetime):
+            value = value.isoformat() + "Z"
+        data[field] = value
+    return data
+
+
+@api.after_request
+def gzip_response(response):
+    """
+    Gzips API responses for clients that accept gzip. ETags are weak, so
+    they stay the same whether or not the response is gzipped.
+    """
+
+    response.vary.add("Accept-Encoding")
+    if (response.status_code != 200 or response.direct_passthrough
+            or "Content-Encoding" in response.headers
+            or not request.accept_encodings["gzip"]):
+        return response
+
+    data = response.get_data()
+    if len(data) < GZIP_MIN_SIZE:
+        return response
+    response.set_data(gzip.compress(data, 6))
+    response.headers["Content-Encoding"] = "gzip"
+    return response
+
+
+@api.errorhandler(HTTPException)
+def api_error(error):
+    """
+    Returns errors from API routes as JSON. The app's 404 and 405 handlers
+    call this for API URLs, as they are used before a blueprint's.
+    """
+
+    headers = [(name, value) for name, value in error.get_headers()
+               if name != "Content-Type"]
+    return jsonify(error=error.description), error.code, headers
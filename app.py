@@ -1,14 +1,42 @@
 import os
+import tempfile
+import threading
+import time
 from flask import (
-    Flask, flash, render_template,
-    session, request, url_for, redirect)
+    Flask, flash, render_template, session, request, url_for, redirect,
+    abort, jsonify, Response, send_file, g)
+from jinja2 import FileSystemBytecodeCache
 from flask_pymongo import PyMongo
 from bson.objectid import ObjectId
+from pymongo import InsertOne, UpdateOne
 from flask_sslify import SSLify
-from datetime import date, timedelta
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.middleware.proxy_fix import ProxyFix
+from datetime import datetime, timedelta
 from validation import (
-    valid_registration, login_required, valid_recipe, valid_password_update)
+    valid_registration, login_required, valid_recipe, valid_password_update,
+    normalise_recipe)
+from pagination import (
+    keyset_page, parse_cursor, user_with_recipes, CARD_FIELDS)
+from search import search_recipes
+from indexes import ensure_indexes, unindexed_queries
+from cache import RecipeCache, make_backend
+from hashing import PasswordHasher, HashingBusy
+from metrics import RequestMetrics
+from conditional import build_time, build_version, cached_page
+from fragments import FragmentCache
+from images import ImageStore, ImageError, SIZES, FORMATS
+from assets import Assets
+from limits import RateLimiter, make_buckets, parse_budgets
+from writes import WriteQueue
+from sessions import (
+    ServerSessionInterface, UserSnapshots, make_store, regenerate)
+from api import (
+    api, api_error, parse_fields, parse_ids, recipe_json, CARD_FIELD_NAMES,
+    RECIPE_FIELDS)
+from popular import change_count, change_counts, get_popular
+from summary import (
+    SUMMARY_ID, get_summary, rebuild, record_added, record_edited,
+    record_removed, record_reassigned)
 if os.path.exists("env.py"):
     import env
 
@@ -22,73 +50,356 @@ app.config["MONGO_DBNAME"] = os.environ.get("MONGO_DBNAME")
 app.config["MONGO_URI"] = os.environ.get("MONGO_URI")
 app.secret_key = os.environ.get("SECRET_KEY")
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(minutes=120)
-
-mongo = PyMongo(app)
+app.config["RECIPES_PER_PAGE"] = int(
+    os.environ.get("RECIPES_PER_PAGE", 12))
+app.config["CACHE_TTL"] = int(os.environ.get("CACHE_TTL", 60))
+app.config["CACHE_MAX_SIZE"] = int(os.environ.get("CACHE_MAX_SIZE", 1024))
+app.config["CACHE_REDIS_URL"] = os.environ.get("CACHE_REDIS_URL")
+app.config["FRAGMENT_CACHE_SIZE"] = int(
+    os.environ.get("FRAGMENT_CACHE_SIZE", 4096))
+app.config["IMAGE_CACHE_DIR"] = os.environ.get(
+    "IMAGE_CACHE_DIR",
+    os.path.join(tempfile.gettempdir(), "eating-vegan-images"))
+app.config["IMAGE_CACHE_MAX_MB"] = int(
+    os.environ.get("IMAGE_CACHE_MAX_MB", 256))
+app.config["CASCADE_IN_BACKGROUND"] = os.environ.get(
+    "CASCADE_IN_BACKGROUND", "").lower() == "true"
+app.config["PASSWORD_HASH_ITERATIONS"] = int(
+    os.environ.get("PASSWORD_HASH_ITERATIONS", 150000))
+# Each gunicorn worker has its own hashing processes, so keep this small
+app.config["PASSWORD_HASH_WORKERS"] = int(
+    os.environ.get("PASSWORD_HASH_WORKERS", 1))
+app.config["PASSWORD_HASH_MAX_PENDING"] = int(
+    os.environ.get("PASSWORD_HASH_MAX_PENDING", 16))
+
+app.config["MONGO_MAX_POOL_SIZE"] = int(
+    os.environ.get("MONGO_MAX_POOL_SIZE", 100))
+app.config["MONGO_MIN_POOL_SIZE"] = int(
+    os.environ.get("MONGO_MIN_POOL_SIZE", 0))
+app.config["MONGO_CONNECT_TIMEOUT_MS"] = int(
+    os.environ.get("MONGO_CONNECT_TIMEOUT_MS", 5000))
+app.config["MONGO_SERVER_SELECTION_TIMEOUT_MS"] = int(
+    os.environ.get("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000))
+app.config["MONGO_WAIT_QUEUE_TIMEOUT_MS"] = int(
+    os.environ.get("MONGO_WAIT_QUEUE_TIMEOUT_MS", 2000))
+app.config["PAGE_MAX_AGE"] = int(os.environ.get("PAGE_MAX_AGE", 60))
+app.config["SLOW_REQUEST_MS"] = int(os.environ.get("SLOW_REQUEST_MS", 500))
+app.config["METRICS_TOKEN"] = os.environ.get("METRICS_TOKEN")
+# Heroku (which sets DYNO) always has its router in front of the app
+app.config["TRUSTED_PROXIES"] = int(os.environ.get(
+    "TRUSTED_PROXIES", 1 if os.environ.get("DYNO") else 0))
+app.config["RATE_LIMIT_ENABLED"] = os.environ.get(
+    "RATE_LIMIT_ENABLED", "true").lower() == "true"
+app.config["RATE_LIMITS"] = os.environ.get("RATE_LIMITS")
+app.config["RATE_LIMIT_REDIS_URL"] = os.environ.get("RATE_LIMIT_REDIS_URL")
+app.config["MAX_EXPENSIVE_REQUESTS"] = int(
+    os.environ.get("MAX_EXPENSIVE_REQUESTS", 3))
+app.config["WRITE_QUEUE_INTERVAL"] = float(
+    os.environ.get("WRITE_QUEUE_INTERVAL", 1))
+app.config["WRITE_QUEUE_MAX_SIZE"] = int(
+    os.environ.get("WRITE_QUEUE_MAX_SIZE", 10000))
+app.config["SESSION_STORE"] = os.environ.get("SESSION_STORE", "cookie")
+app.config["SESSION_DIR"] = os.environ.get(
+    "SESSION_DIR",
+    os.path.join(tempfile.gettempdir(), "eating-vegan-sessions"))
+app.config["SESSION_REDIS_URL"] = os.environ.get("SESSION_REDIS_URL")
+app.config["TEMPLATE_CACHE_DIR"] = os.environ.get(
+    "TEMPLATE_CACHE_DIR",
+    os.path.join(tempfile.gettempdir(), "eating-vegan-templates"))
+
+# Takes the client's IP address from the X-Forwarded-For header added by
+# each trusted proxy (Heroku's router is one), for the rate limits
+if app.config["TRUSTED_PROXIES"]:
+    app.wsgi_app = ProxyFix(
+        app.wsgi_app, x_for=app.config["TRUSTED_PROXIES"])
+
+request_metrics = RequestMetrics(
+    slow_ms=app.config["SLOW_REQUEST_MS"], logger=app.logger)
+request_metrics.init_app(app)
+
+# connect=False opens no connections until the first query, so the client
+# is safe to create before gunicorn forks its workers
+mongo = PyMongo(
+    app, connect=False,
+    maxPoolSize=app.config["MONGO_MAX_POOL_SIZE"],
+    minPoolSize=app.config["MONGO_MIN_POOL_SIZE"],
+    connectTimeoutMS=app.config["MONGO_CONNECT_TIMEOUT_MS"],
+    serverSelectionTimeoutMS=app.config["MONGO_SERVER_SELECTION_TIMEOUT_MS"],
+    waitQueueTimeoutMS=app.config["MONGO_WAIT_QUEUE_TIMEOUT_MS"],
+    event_listeners=[request_metrics.listener])
 
 
 # Global variables used throughout functions #
 
 default_pic = ("/static/images/default-profile-picture.jpg")
-date = date.today()
 recipes_data = mongo.db.recipes
 users_data = mongo.db.users
 subscribers_data = mongo.db.subscribers
+summary_data = mongo.db.recipe_summary
+hasher = PasswordHasher(
+    iterations=app.config["PASSWORD_HASH_ITERATIONS"],
+    workers=app.config["PASSWORD_HASH_WORKERS"],
+    max_pending=app.config["PASSWORD_HASH_MAX_PENDING"])
+recipe_cache = RecipeCache(
+    make_backend(app.config), ttl=app.config["CACHE_TTL"])
+fragment_cache = FragmentCache(
+    max_size=app.config["FRAGMENT_CACHE_SIZE"])
+fragment_cache.init_app(app)
+image_store = ImageStore(
+    app.config["IMAGE_CACHE_DIR"],
+    max_bytes=app.config["IMAGE_CACHE_MAX_MB"] * 1024 * 1024)
+image_store.init_app(app)
+static_assets = Assets(app)
+# Part of every page's ETag and Last-Modified, so pages cached before a
+# deploy are replaced
+app.config["BUILD_VERSION"] = build_version(app)
+app.config["BUILD_TIME"] = build_time()
+limiter = RateLimiter(
+    make_buckets(app.config), parse_budgets(app.config["RATE_LIMITS"]),
+    max_expensive=app.config["MAX_EXPENSIVE_REQUESTS"],
+    enabled=app.config["RATE_LIMIT_ENABLED"])
+write_queue = WriteQueue(
+    interval=app.config["WRITE_QUEUE_INTERVAL"],
+    max_size=app.config["WRITE_QUEUE_MAX_SIZE"], logger=app.logger)
+session_store = make_store(app.config, logger=app.logger)
+if session_store is not None:
+    app.session_interface = ServerSessionInterface(session_store)
+user_snapshots = UserSnapshots(session_store)
+meal_names = {
+    "breakfast": "Breakfast",
+    "lunch": "Lunch",
+    "dinner": "Dinner",
+    "desserts": "Desserts",
+}
+
+
+# Startup #
+
+# Compiled templates are also written to disk, so a restarted worker loads
+# them instead of compiling them again
+os.makedirs(app.config["TEMPLATE_CACHE_DIR"], exist_ok=True)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(
+    app.config["TEMPLATE_CACHE_DIR"])
+
+# Process that has run startup(), see below
+started_in = None
+
+
+def compile_templates():
+    """
+    Compiles every template so that no request has to. Gunicorn calls this
+    before it forks the workers, so they all share the compiled templates.
+    Returns the number of templates compiled.
+    """
+
+    names = app.jinja_env.list_templates(extensions=["html"])
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+
+def create_indexes():
+    """
+    Creates or verifies the indexes from indexes.py, and logs any query that
+    has no index to support it.
+    """
+
+    for problem in ensure_indexes(mongo.db):
+        app.logger.error("Could not create index %s", problem)
+    for shape in unindexed_queries(mongo.db):
+        app.logger.warning("No index for query on %s", shape)
+
+
+def build_summary():
+    """
+    Builds the recipe summary from summary.py if it doesn't exist yet.
+    """
+
+    if not summary_data.find_one({"_id": SUMMARY_ID}, {"_id": 1}):
+        rebuild(recipes_data, summary_data)
+
+
+def startup():
+    """
+    Gets this process ready to take requests: compiles the templates,
+    connects to MongoDB (the driver then keeps at least MONGO_MIN_POOL_SIZE
+    connections open in the background), checks the indexes and the recipe
+    summary, and logs how long each step took. Called by gunicorn in each
+    worker, see gunicorn.conf.py, or else before the first request.
+    """
+
+    global started_in
+
+    timings = []
+    start = time.perf_counter()
+    for step in (compile_templates,
+                 lambda: mongo.db.command("ping"),
+                 create_indexes, build_summary):
+        step_start = time.perf_counter()
+        step()
+        timings.append((time.perf_counter() - step_start) * 1000)
+    started_in = os.getpid()
+    app.logger.info(
+        "Started in %.0fms: templates %.0fms, MongoDB connection %.0fms, "
+        "indexes %.0fms, recipe summary %.0fms",
+        (time.perf_counter() - start) * 1000, *timings)
+
+
+@app.before_first_request
+def start_if_needed():
+    """
+    Runs startup() if this process hasn't, for example under flask run, or
+    if MongoDB couldn't be reached when the worker started.
+    """
+
+    if started_in != os.getpid():
+        startup()
+
+
+def now():
+    """
+    Returns the time the current request started, in UTC. It is only read
+    once per request, so every date the request saves is the same.
+    """
+
+    if "now" not in g:
+        g.now = datetime.utcnow()
+    return g.now
 
 
 # Homepage #
 
 @app.route('/')
 def index():
-    return render_template("index.html")
+    return render_template(
+        "index.html", summary=recipe_summary(), popular=popular_recipes())
 
 
 # Recipe functions #
 
+def listing_page(namespace, query):
+    """
+    Returns the page of recipes after the "after" cursor in the URL, and the
+    cursor for the next page. Pages are cached under namespace.
+    """
+
+    after = parse_cursor(request.args.get("after"))
+    return recipe_cache.get_or_load(
+        recipe_cache.namespaced(namespace, after),
+        lambda: keyset_page(recipes_data, query, after=after,
+                            per_page=app.config["RECIPES_PER_PAGE"]))
+
+
+def recipe_summary():
+    """
+    Returns the recipe summary (counts per meal and newest recipes).
+    It is cached with the listing pages so it is refreshed on every write.
+    """
+
+    return recipe_cache.get_or_load(
+        recipe_cache.namespaced("listing", "summary"),
+        lambda: get_summary(summary_data))
+
+
+def popular_recipes():
+    """
+    Returns the most saved recipes, read from the saved_count index.
+    Saves don't invalidate it, so it is up to CACHE_TTL seconds behind,
+    but it is refreshed with the listing pages when recipes change.
+    """
+
+    return recipe_cache.get_or_load(
+        recipe_cache.namespaced("listing", "popular"),
+        lambda: get_popular(recipes_data))
+
+
+def summary_etag(summary):
+    """
+    Returns the part of the summary shown on listing pages (the meal counts
+    in the filter) as a string for the page's ETag.
+    """
+
+    return "{}:{}".format(
+        summary["total"], sorted(summary["meal_counts"].items()))
+
+
+def invalidate_recipes(recipe_ids=(), meals=()):
+    """
+    Removes cached copies and rendered fragments of the given recipes and
+    every cached listing page that could show them.
+    """
+
+    fragment_cache.invalidate(*recipe_ids)
+    recipe_cache.invalidate(
+        *["recipe:{}".format(recipe_id) for recipe_id in recipe_ids])
+    recipe_cache.invalidate_namespace(
+        "listing", *["meal:{}".format(meal) for meal in set(meals)])
+
+
 @app.route('/recipes')
 def recipes():
     """
-    Lists all recipes in mongoDB data.
+    Lists recipes in mongoDB data, one page at a time.
     """
 
-    recipes = list(recipes_data.find())
-    return render_template('recipes.html', recipes=recipes)
+    recipes, next_after = listing_page("listing", {})
+    next_url = next_after and url_for("recipes", after=next_after)
+    summary = recipe_summary()
+    # The popular recipes are only shown above the first page
+    popular = [] if request.args.get("after") else popular_recipes()
+
+    return cached_page(popular + recipes, lambda: render_template(
+        'recipes.html', recipes=recipes, next_url=next_url,
+        summary=summary, popular=popular),
+        max_age=app.config["PAGE_MAX_AGE"], extra=summary_etag(summary))
 
 
 @app.route('/recipes/<meal>')
 def meals(meal):
     """
     Displays different meals when different filter options are clicked on page.
+    Returns 404 if the meal is not one of the filter options.
     """
 
-    if meal == "breakfast":
-        recipes = recipes_data.find({"meal_name": "Breakfast"})
-    elif meal == "lunch":
-        recipes = recipes_data.find({"meal_name": "Lunch"})
-    elif meal == "dinner":
-        recipes = recipes_data.find({"meal_name": "Dinner"})
-    elif meal == "desserts":
-        recipes = recipes_data.find({"meal_name": "Desserts"})
+    if meal not in meal_names:
+        abort(404)
 
-    return render_template(
-        'recipes.html', meal=meal, recipes=recipes)
+    recipes, next_after = listing_page(
+        "meal:{}".format(meal_names[meal]), {"meal_name": meal_names[meal]})
+    next_url = next_after and url_for("meals", meal=meal, after=next_after)
+
+    summary = recipe_summary()
+
+    return cached_page(recipes, lambda: render_template(
+        'recipes.html', meal=meal, recipes=recipes, next_url=next_url,
+        summary=summary), max_age=app.config["PAGE_MAX_AGE"],
+        extra=summary_etag(summary))
 
 
 @app.route('/recipes', methods=["POST"])
+@limiter.limit("search", expensive=True)
 def search():
     """
     Searches the recipe index. Will return results for,
     Recipe name, description and ingredients.
+    Best matches are shown first, one page at a time. If searching from a
+    meal filter page only recipes for that meal are searched.
     """
 
     # Fetches users search input
     query = request.form.get("search-query")
-    # Search results
-    recipes = recipes_data.find({"$text": {"$search": query}})
-    # Counts all search results
-    searched_recipes = recipes.count()
+    meal = request.form.get("meal")
+    page = max(request.form.get("page", 1, type=int), 1)
+    per_page = app.config["RECIPES_PER_PAGE"]
+    # Search results and count of all search results
+    recipes, searched_recipes = search_recipes(
+        recipes_data, query, meal_name=meal_names.get(meal),
+        page=page, per_page=per_page)
+    next_page = page + 1 if page * per_page < searched_recipes else None
 
-    return render_template("recipes.html", query=query,
-                           recipes=recipes, searched_recipes=searched_recipes)
+    return render_template("recipes.html", query=query, meal=meal,
+                           recipes=recipes, searched_recipes=searched_recipes,
+                           next_page=next_page, summary=recipe_summary())
 
 
 @app.route('/recipe/<recipe_id>')
@@ -96,13 +407,18 @@ def recipe_page(recipe_id):
     """
     Returns page for specific recipe ID.
     """
-    recipe = recipes_data.find_one({"_id": ObjectId(recipe_id)})
-    return render_template('recipe.html', recipe=recipe)
+    recipe = recipe_cache.get_or_load(
+        "recipe:{}".format(recipe_id),
+        lambda: recipes_data.find_one({"_id": ObjectId(recipe_id)}))
+    return cached_page(
+        [recipe], lambda: render_template('recipe.html', recipe=recipe),
+        max_age=app.config["PAGE_MAX_AGE"])
 
 
 # Login / register function #
 
 @app.route('/login', methods=["GET", "POST"])
+@limiter.limit("login", expensive=True)
 def login():
     """
     Logs user in if username exists in database and password is correct.
@@ -118,9 +434,15 @@ def login():
         {"username": request.form.get("username").lower()})
 
     # Checks if usersname exists and password matches database
-    if existing_user and check_password_hash(
-            existing_user["password"], password):
-        # Adds user to session
+    if existing_user and hasher.check(existing_user["password"], password):
+        # Upgrades password hashes made with older hash settings
+        if hasher.needs_rehash(existing_user["password"]):
+            users_data.update_one(
+                {"_id": existing_user["_id"]},
+                {"$set": {"password": hasher.hash(password)}})
+            user_snapshots.invalidate(existing_user["username"])
+        # Adds user to session, under a new session id
+        regenerate(session)
         session["user"] = request.form.get("username").lower()
         return redirect(url_for(
             "profile", username=session["user"]))
@@ -130,6 +452,7 @@ def login():
 
 
 @app.route('/register', methods=["GET", "POST"])
+@limiter.limit("register", expensive=True)
 def register():
     """
     Registers user and adds to database if the username and email address
@@ -157,14 +480,15 @@ def register():
         register = {
             "username": request.form.get("username").lower(),
             "email": request.form.get("email").lower(),
-            "password": generate_password_hash(request.form.get("password")),
-            "date_joined": date.strftime("%d/%m/%Y"),
+            "password": hasher.hash(request.form.get("password")),
+            "date_joined": now().strftime("%d/%m/%Y"),
             "profile_image": request.form.get(
                 "profile_img") or default_pic,
             "saved_recipes": []
         }
         # Adds user to users database
         users_data.insert_one(register)
+        regenerate(session)
         session["user"] = request.form.get("username").lower()
         flash("Welcome! Thank you for sigining up!😊")
         return redirect(url_for(
@@ -182,6 +506,7 @@ def logout():
 
     flash("Goodbye! You have been logged out")
     session.pop("user")
+    session.pop("_user", None)
     return redirect(url_for("login"))
 
 
@@ -191,23 +516,66 @@ def logout():
 @login_required
 def profile(username):
     """
-    Displays all recipes created by user.
-    If admin is logged in all recipes will show.
+    Displays the recipes created by user, one page at a time.
+    If admin is logged in all recipes will show, and can be filtered by
+    meal (?meal=lunch) and by who created them (?created_by=<username>).
     """
 
-    # Fetches all user's information from database
-    user = users_data.find_one({"username": session['user']})
-
     # Checks if user is admin and returns all recipes
     if session['user'] == "admin":
-        recipes = list(recipes_data.find())
+        meal = request.args.get("meal")
+        created_by = request.args.get("created_by", "").strip() or None
+        query = {}
+        if meal in meal_names:
+            query["meal_name"] = meal_names[meal]
+        if created_by:
+            query["created_by"] = created_by
     # If user is not admin, users recipes will show
     else:
-        recipes = list(recipes_data.find(
-            {"created_by": session['user']}))
+        meal = created_by = None
+        query = {"created_by": session['user']}
+
+    # Recipe counts not filtered by creator are kept in the summary, so
+    # only a creator's recipes are counted
+    total = None
+    if "created_by" not in query:
+        summary = recipe_summary()
+        total = summary["meal_counts"].get(
+            query["meal_name"], 0) if query else summary["total"]
+
+    # Fetches the user's information and a page of recipes in one query
+    user, recipes, next_after, total = user_with_recipes(
+        users_data, recipes_data, session['user'], query,
+        after=parse_cursor(request.args.get("after")),
+        per_page=app.config["RECIPES_PER_PAGE"], total=total)
+    next_url = next_after and url_for(
+        "profile", username=username, after=next_after, meal=meal,
+        created_by=created_by)
 
     return render_template(
-        "profile.html", user=user, recipes=recipes, username=session['user'])
+        "profile.html", user=user, recipes=recipes, username=session['user'],
+        total=total, next_url=next_url, meal=meal, created_by=created_by,
+        meal_names=meal_names)
+
+
+def recipe_form():
+    """
+    Returns the recipe in the add or edit recipe form, tidied by
+    normalise_recipe() from validation.py the same way as imported recipes.
+    """
+
+    return normalise_recipe({
+        "meal_name": request.form.get("meal_name"),
+        "recipe_name": request.form.get("recipe_name"),
+        "ingredients": request.form.get("ingredients"),
+        "description": request.form.get("description"),
+        "recommendation": request.form.get("recos"),
+        "yield": request.form.get("yield"),
+        "active_time": request.form.get("active_time"),
+        "total_time": request.form.get("total_time"),
+        "img_url": request.form.get("img_url"),
+        "method": request.form.get("method"),
+    })
 
 
 @app.route('/add-recipe', methods=["GET", "POST"])
@@ -223,24 +591,18 @@ def add_recipe():
 
     # Checks all form inputs are correct lengths from validate.py
     if valid_recipe():
-        recipe = {
-            "meal_name": request.form.get("meal_name"),
-            "recipe_name": request.form.get("recipe_name"),
-            "ingredients": request.form.get("ingredients"),
-            "description": request.form.get("description").capitalize(),
-            "recommendation": request.form.get("recos").capitalize(),
-            "yield": request.form.get("yield"),
-            "active_time": request.form.get(
-                "active_time").replace('mins', 'minutes').title(),
-            "total_time": request.form.get(
-                "total_time").replace('mins', 'minutes').title(),
-            "img_url": request.form.get("img_url"),
-            "method": request.form.get("method"),
+        recipe = recipe_form()
+        recipe.update({
             "created_by": session["user"],
-            "date_created": date.strftime("%d/%m/%Y"),
-        }
+            "date_created": now().strftime("%d/%m/%Y"),
+            "version": 1,
+            "updated_at": now(),
+            "saved_count": 0,
+        })
         # Inserts new recipe to recipes database
         recipes_data.insert_one(recipe)
+        record_added(summary_data, recipe)
+        invalidate_recipes(meals=[recipe["meal_name"]])
         flash("Recipe Successfully Added 🍽")
         return redirect(url_for("recipes"))
     # Redirects back to form if invalid recipe
@@ -255,19 +617,78 @@ def saved_recipes():
     """
     Displays all the users saved recipes array.
     """
-    # Fetches users data and their saved recipes
-    user = users_data.find_one({"username": session["user"]})
+
+    saved_rec = load_saved_recipes(current_user())
+    return render_template(
+        'saved-recipes.html', saved=saved_rec, saved_rec=saved_rec)
+
+
+def current_user():
+    """
+    Returns the logged in user's snapshot from their session (see
+    sessions.py), loading the user from MongoDB only if it is out of date.
+    """
+
+    username = session["user"]
+    return user_snapshots.get(session, username, lambda: users_data.find_one(
+        {"username": username}, {"password": 0}))
+
+
+def load_saved_recipes(user):
+    """
+    Returns a users saved recipes (card fields only), fetched in one query
+    and kept in the order they were saved. Any saved ids for recipes that
+    no longer exist are removed from the users saved array in the
+    background.
+    """
+    username = user["username"]
     saved = user["saved_recipes"]
-    saved_rec = []  # Creates empty array
 
-    # Loops through users saved recipes
-    for recipe_id in saved:
-        # Assigns recipe id to it's recipe in data and adds to empty array
-        recipe_id = recipes_data.find_one({'_id': ObjectId(recipe_id)})
-        saved_rec.append(recipe_id)
+    # Fetches all saved recipes at once and puts them back in saved order
+    found = {recipe["_id"]: recipe for recipe in recipes_data.find(
+        {"_id": {"$in": saved}}, CARD_FIELDS)}
+    saved_rec = [found[recipe_id] for recipe_id in saved
+                 if recipe_id in found]
 
-    return render_template(
-        'saved-recipes.html', saved=saved, saved_rec=saved_rec)
+    # Removes ids of deleted recipes without holding up the page
+    stale = [recipe_id for recipe_id in saved if recipe_id not in found]
+    if stale:
+        write_queue.put(users_data, UpdateOne(
+            {"username": username},
+            {"$pullAll": {"saved_recipes": stale}}))
+        user_snapshots.invalidate(username)
+
+    return saved_rec
+
+
+def set_saved(username, recipe_id, saved):
+    """
+    Adds a recipe id to (or removes it from) a users saved recipes array
+    in one update. Returns True if the array changed, and only then
+    changes the recipe's saved_count, so repeated saves count once.
+    """
+
+    update = "$addToSet" if saved else "$pull"
+    result = users_data.update_one(
+        {"username": username},
+        {update: {"saved_recipes": recipe_id}})
+    if result.modified_count != 1:
+        return False
+    user_snapshots.invalidate(username)
+    change_count(recipes_data, recipe_id, 1 if saved else -1)
+    return True
+
+
+def wants_json():
+    """
+    Checks if the request asked for a JSON response instead of a redirect.
+    HTML is listed first so a browser or form sending "*/*" still gets the
+    redirect, and JSON is only chosen when it is asked for by name.
+    """
+
+    best = request.accept_mimetypes.best_match(
+        ["text/html", "application/json"])
+    return best == "application/json"
 
 
 @app.route('/save/<recipe_id>', methods=["POST"])
@@ -275,20 +696,17 @@ def saved_recipes():
 def save_recipe(recipe_id):
     """
     Saves recipe to users saved array if recipe not already saved.
+    Returns JSON instead of redirecting if the request asks for JSON.
     """
-    # Fetches users data and their saved recipes
-    user = users_data.find_one({"username": session["user"]})
-    saved = user["saved_recipes"]
+    # Adds recipe id to users saved recipe array if it isn't already in it
+    changed = set_saved(session["user"], ObjectId(recipe_id), True)
 
-    # Checks if the recipe is aleady in users saved array
-    if ObjectId(recipe_id) in saved:
+    if wants_json():
+        return jsonify(saved=True, changed=changed)
+    if changed:
+        flash("Recipe Saved to profile!💚")
+    else:
         flash("Recipe already saved!😊")
-        return redirect(request.referrer)
-    # If not saved add recipe id to users saved recipe array
-    users_data.update_one(
-        user, {"$push": {
-            "saved_recipes": ObjectId(recipe_id)}})
-    flash("Recipe Saved to profile!💚")
 
     return redirect(request.referrer)
 
@@ -298,12 +716,13 @@ def save_recipe(recipe_id):
 def remove_saved_recipe(recipe_id):
     """
     Removes recipe ID from the users "saved_recipes" array.
+    Returns JSON instead of redirecting if the request asks for JSON.
     """
-    # Fetches users data
-    user = users_data.find_one({"username": session["user"]})
     # Removes recipe id from users saved recipe array
-    users_data.update_one(
-        user, {"$pull": {"saved_recipes": ObjectId(recipe_id)}})
+    changed = set_saved(session["user"], ObjectId(recipe_id), False)
+
+    if wants_json():
+        return jsonify(saved=False, changed=changed)
     flash("Recipe removed from saved")
 
     return redirect(request.referrer)
@@ -330,24 +749,17 @@ def edit_recipe(recipe_id):
             return render_template('edit-recipe.html', recipe=recipe)
         # Checks all form inputs are correct lengths from validate.py
         if valid_recipe():
+            edits = recipe_form()
+            edits.update({
+                "last_edited_by": session['user'],
+                "updated_at": now()
+            })
             recipes_data.update_one(
                 {"_id": ObjectId(recipe_id)},
-                {'$set': {
-                    "meal_name": request.form.get("meal_name"),
-                    "recipe_name": request.form.get("recipe_name"),
-                    "ingredients": request.form.get("ingredients"),
-                    "description": request.form.get(
-                        "description").capitalize(),
-                    "recommendation": request.form.get("recos").capitalize(),
-                    "yield": request.form.get("yield"),
-                    "active_time": request.form.get(
-                        "active_time").replace('mins', 'minutes').title(),
-                    "total_time": request.form.get(
-                        "total_time").replace('mins', 'minutes').title(),
-                    "img_url": request.form.get("img_url"),
-                    "method": request.form.get("method"),
-                    "last_edited_by": session['user']
-                }})
+                {'$set': edits, '$inc': {"version": 1}})
+            record_edited(summary_data, recipe, edits)
+            invalidate_recipes(
+                [recipe_id], meals=[recipe["meal_name"], edits["meal_name"]])
             flash("Recipe Updated 😊")
             return redirect(url_for("recipe_page", recipe_id=recipe_id))
         else:
@@ -357,6 +769,29 @@ def edit_recipe(recipe_id):
         return render_template('/errors/404.html'), 404
 
 
+def cascade(description, collection, query, update, after=None):
+    """
+    Applies update to every document matching query in one update_many and
+    logs how long it took, then calls after (if given) so anything that
+    depends on the update sees it. If CASCADE_IN_BACKGROUND is set both run
+    in a background thread so the request doesn't wait for them.
+    """
+
+    def run():
+        start = time.perf_counter()
+        result = collection.update_many(query, update)
+        app.logger.info(
+            "%s: %d documents updated in %.1fms", description,
+            result.modified_count, (time.perf_counter() - start) * 1000)
+        if after:
+            after()
+
+    if app.config["CASCADE_IN_BACKGROUND"]:
+        threading.Thread(target=run, daemon=True).start()
+    else:
+        run()
+
+
 @app.route('/recipe/delete-recipe/<recipe_id>')
 @login_required
 def delete_recipe(recipe_id):
@@ -369,17 +804,21 @@ def delete_recipe(recipe_id):
 
     recipe = recipes_data.find_one({"_id": ObjectId(recipe_id)})
     created_by = recipe["created_by"]
-    users_saved = list(users_data.find(
-        {"saved_recipes": ObjectId(recipe_id)}))
 
     # Checks user logged in is user who created recipe or admin
     if created_by == session['user'] or session['user'] == "admin":
-        # Loops through all users saved recipes
-        for users in users_saved:
-            # Removes deleted recipe id from all users saved array
-            users_data.update_many(
-                users, {"$pull": {"saved_recipes": ObjectId(recipe_id)}})
-        recipes_data.delete_one(recipe)
+        recipes_data.delete_one({"_id": recipe["_id"]})
+
+        def recipe_removed():
+            record_removed(summary_data, recipe, recipes_data)
+            invalidate_recipes([recipe_id], meals=[recipe["meal_name"]])
+
+        # Removes deleted recipe id from all users saved arrays at once
+        cascade(
+            "Removed deleted recipe from saved recipes", users_data,
+            {"saved_recipes": recipe["_id"]},
+            {"$pull": {"saved_recipes": recipe["_id"]}},
+            after=recipe_removed)
         flash("Recipe Succesfully Removed!")
     # If user didn't create recipe or is not admin, 404 error returns
     else:
@@ -399,19 +838,33 @@ def delete_user(username):
     passed in the URL to avoid other users knowing the URL is correct.
     """
 
-    users_recipes = list(recipes_data.find({"created_by": session["user"]}))
-
     # If session user matches username in URL
     if session['user'] == username:
-        # Loops through users recipes and updates them to be managed by admin
-        for recipe in users_recipes:
-            recipes_data.update(
-                    recipe,
-                    {'$set': {
-                        "created_by": "admin"
-                    }})
-        # Removes user from database
-        users_data.remove({"username": session['user']})
+        # Fetches the id and meal of each of the users recipes for the cache
+        users_recipes = list(recipes_data.find(
+            {"created_by": session["user"]}, {"meal_name": 1}))
+
+        def recipes_reassigned():
+            record_reassigned(
+                summary_data, username, "admin", len(users_recipes))
+            invalidate_recipes(
+                [recipe["_id"] for recipe in users_recipes],
+                meals=[recipe["meal_name"] for recipe in users_recipes])
+
+        # Updates all the users recipes to be managed by admin at once
+        cascade(
+            "Handed deleted user's recipes to admin", recipes_data,
+            {"created_by": session["user"]},
+            {'$set': {
+                "created_by": "admin", "updated_at": now()},
+             '$inc': {"version": 1}},
+            after=recipes_reassigned)
+        # Removes user from database, and their saves from saved counts
+        user = users_data.find_one_and_delete(
+            {"username": session['user']}, {"saved_recipes": 1})
+        change_counts(recipes_data, (user or {}).get("saved_recipes"), -1)
+        user_snapshots.invalidate(session['user'])
+        session.pop("_user", None)
         session.pop("user")
         flash("Sorry to see you go! Your user has been deleted.")
     # If session user does not match username, 404 error returns
@@ -430,7 +883,6 @@ def update_password(username):
     """
 
     current_password = request.form.get("password")
-    user = users_data.find_one({'username': session['user']})
     new_password = request.form.get('new-password')
     confirm_password = request.form.get("confirm-password")
 
@@ -439,19 +891,23 @@ def update_password(username):
         return render_template(
             'update-password.html', username=session['user'])
 
+    # The password hash isn't kept in the session, so it is always loaded
+    user = users_data.find_one(
+        {'username': session['user']}, {"password": 1})
+
     # Checks current password matches password in database
-    if check_password_hash(user["password"], current_password):
+    if hasher.check(user["password"], current_password):
         # Checks the new passwords match the password format from validate.py
         if valid_password_update():
             # Checks both new passwords match
             if new_password == confirm_password:
                 # Updates the password and redirects to profile page
                 users_data.update_one(
-                    user,
+                    {"_id": user["_id"]},
                     {'$set': {
-                        'password': generate_password_hash
-                        (new_password)
+                        'password': hasher.hash(new_password)
                     }})
+                user_snapshots.invalidate(session['user'])
                 flash("Password updated! 😊")
                 return redirect(url_for('profile', username=session['user']))
             else:
@@ -477,33 +933,252 @@ def update_profile_pic():
             "profile_image": request.form.get(
                 "profile_img")
         }})
+    user_snapshots.invalidate(session['user'])
     return redirect(request.referrer)
 
 
 # Newsletter Subscribe #
 
 @app.route('/subscribe', methods=["POST"])
+@limiter.limit("subscribe")
 def subscribe_user():
     """
     Subscribes email to newsletter if email is not subscribed already.
+    The insert is queued and made in a batch with other subscriptions, and
+    emails already subscribed are skipped by the unique index.
     """
 
-    existing_sub = subscribers_data.find_one(
-        {"subscriber_email": request.form.get("sub_email")})
-    if not existing_sub:
-        subscribe = {
-            "subscriber_email": request.form.get("sub_email")}
-        subscribers_data.insert_one(subscribe)
+    write_queue.put(subscribers_data, InsertOne(
+        {"subscriber_email": request.form.get("sub_email")}))
     return redirect(request.referrer)
 
 
+# Images #
+
+@app.route('/images/<token>/<size>.<fmt>')
+def image(token, size, fmt):
+    """
+    Serves a thumbnail of a recipe or profile image, see images.py.
+    Thumbnails never change for a URL, so browsers may keep them for a year.
+    If the image can't be fetched or resized the original is linked to.
+    """
+
+    try:
+        url = image_store.source_url(token)
+    except KeyError:
+        abort(404)
+    if size not in SIZES or fmt not in FORMATS:
+        return redirect(url)
+    try:
+        path = image_store.variant(url, size, fmt)
+    except ImageError as error:
+        app.logger.warning("%s", error)
+        return redirect(url)
+
+    response = send_file(path, mimetype=FORMATS[fmt][1], conditional=True)
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
+
+
+# JSON API #
+
+@api.route('/recipes', endpoint="recipes")
+def api_recipes():
+    """
+    Lists recipes one page at a time, like the recipes page.
+    ?meal=<meal> lists one meal, ?after=<cursor> gets the next page and
+    ?fields= picks which card fields are returned.
+    """
+
+    fields = parse_fields(CARD_FIELD_NAMES)
+    meal = request.args.get("meal")
+    if meal and meal not in meal_names:
+        abort(404, description="Unknown meal: {}".format(meal))
+    if meal:
+        recipes, next_after = listing_page(
+            "meal:{}".format(meal_names[meal]),
+            {"meal_name": meal_names[meal]})
+    else:
+        recipes, next_after = listing_page("listing", {})
+
+    return cached_page(recipes, lambda: jsonify(
+        recipes=[recipe_json(recipe, fields) for recipe in recipes],
+        next=next_after), max_age=app.config["PAGE_MAX_AGE"],
+        extra=",".join(fields))
+
+
+@api.route('/recipes/<recipe_id>', endpoint="recipe")
+def api_recipe(recipe_id):
+    """
+    Returns one recipe, with all of its fields unless ?fields= is given.
+    """
+
+    fields = parse_fields(RECIPE_FIELDS)
+    recipe_id = parse_cursor(recipe_id)
+    recipe = recipe_id and recipe_cache.get_or_load(
+        "recipe:{}".format(recipe_id),
+        lambda: recipes_data.find_one({"_id": recipe_id}))
+    if not recipe:
+        abort(404, description="Recipe not found")
+
+    return cached_page([recipe], lambda: jsonify(
+        recipe=recipe_json(recipe, fields)),
+        max_age=app.config["PAGE_MAX_AGE"], extra=",".join(fields))
+
+
+@api.route('/recipes/bulk', endpoint="bulk_recipes")
+def api_bulk_recipes():
+    """
+    Returns the recipes with the ids in ?ids=<id>,<id>, in the same order,
+    in one query. Ids of recipes that don't exist are listed in "missing".
+    """
+
+    fields = parse_fields(RECIPE_FIELDS)
+    ids = parse_ids(request.args.get("ids"))
+    projection = dict.fromkeys(fields + ["version", "updated_at"], 1)
+    found = {recipe["_id"]: recipe for recipe in recipes_data.find(
+        {"_id": {"$in": ids}}, projection)}
+    recipes = [found[recipe_id] for recipe_id in ids if recipe_id in found]
+
+    return cached_page(recipes, lambda: jsonify(
+        recipes=[recipe_json(recipe, fields) for recipe in recipes],
+        missing=[str(recipe_id) for recipe_id in ids
+                 if recipe_id not in found]),
+        max_age=app.config["PAGE_MAX_AGE"],
+        extra="{}:{}".format(",".join(fields), len(recipes)))
+
+
+@api.route('/recipes/search', endpoint="search")
+@limiter.limit("search", methods=("GET",), expensive=True)
+def api_search():
+    """
+    Searches recipes like the search form, best matches first.
+    ?q= is the search, ?meal= searches one meal and ?page= gets the next
+    page of results.
+    """
+
+    query = request.args.get("q", "").strip()
+    if not query:
+        abort(400, description="No search given, use ?q=")
+    fields = parse_fields(CARD_FIELD_NAMES)
+    meal = request.args.get("meal")
+    page = max(request.args.get("page", 1, type=int), 1)
+    per_page = app.config["RECIPES_PER_PAGE"]
+    recipes, total = search_recipes(
+        recipes_data, query, meal_name=meal_names.get(meal),
+        page=page, per_page=per_page)
+
+    return jsonify(
+        recipes=[recipe_json(recipe, fields) for recipe in recipes],
+        total=total,
+        next_page=page + 1 if page * per_page < total else None)
+
+
+@api.route('/saved-recipes', endpoint="saved_recipes")
+@login_required
+def api_saved_recipes():
+    """
+    Returns the logged in users saved recipes, in the order they were saved.
+    """
+
+    fields = parse_fields(CARD_FIELD_NAMES)
+    return jsonify(recipes=[recipe_json(recipe, fields) for recipe
+                            in load_saved_recipes(current_user())])
+
+
+@api.route('/saved-recipes/<recipe_id>', methods=["PUT", "DELETE"],
+           endpoint="save_recipe")
+@login_required
+def api_save_recipe(recipe_id):
+    """
+    Saves (PUT) or unsaves (DELETE) a recipe for the logged in user.
+    """
+
+    recipe_id = parse_cursor(recipe_id)
+    if recipe_id is None:
+        abort(404, description="Recipe not found")
+    saved = request.method == "PUT"
+    changed = set_saved(session["user"], recipe_id, saved)
+    return jsonify(saved=saved, changed=changed)
+
+
+app.register_blueprint(api)
+
+
+# Metrics #
+
+@app.route('/metrics')
+def metrics():
+    """
+    Returns request and cache metrics in the Prometheus text format.
+    If METRICS_TOKEN is set it must be sent as a bearer token.
+    """
+
+    token = app.config["METRICS_TOKEN"]
+    if token and request.headers.get(
+            "Authorization") != "Bearer {}".format(token):
+        abort(404)
+
+    cache_stats = recipe_cache.stats()
+    return Response(
+        request_metrics.render({
+            "recipe_cache_hits_total": cache_stats["hits"],
+            "recipe_cache_misses_total": cache_stats["misses"],
+            "rate_limited_requests_total": limiter.limited,
+            "shed_requests_total": limiter.shed,
+            "queued_writes_total": write_queue.queued,
+            "queued_writes_written_total": write_queue.written,
+            "queued_writes_failed_total": write_queue.failed,
+            "queued_write_batches_total": write_queue.batches,
+        }), mimetype="text/plain; version=0.0.4")
+
+
 # Error Pages #
 
+@app.errorhandler(HashingBusy)
+def hashing_busy(error):
+    '''
+    Handles too many password hashes waiting at once (server busy)
+    '''
+    flash("Sorry, we're very busy right now. Please try again in a moment")
+    return redirect(request.url)
+
+
+def retry_after(error):
+    '''
+    Returns the Retry-After header of an error, if it has one
+    '''
+    return [(name, value) for name, value in error.get_headers()
+            if name == "Retry-After"]
+
+
+@app.errorhandler(429)
+def too_many_requests(error):
+    '''
+    Handles 429 error (too many requests from one client, see limits.py)
+    '''
+    if request.path.startswith(api.url_prefix + "/"):
+        return api_error(error)
+    return render_template('/errors/429.html'), 429, retry_after(error)
+
+
+@app.errorhandler(503)
+def service_unavailable(error):
+    '''
+    Handles 503 error (too many expensive requests at once, see limits.py)
+    '''
+    if request.path.startswith(api.url_prefix + "/"):
+        return api_error(error)
+    return render_template('/errors/503.html'), 503, retry_after(error)
+
+
 @app.errorhandler(404)
 def page_not_found(error):
     '''
     Handles 404 error (page not found)
     '''
+    if request.path.startswith(api.url_prefix + "/"):
+        return api_error(error)
     return render_template('/errors/404.html'), 404
 
 
@@ -520,6 +1195,8 @@ def method_not_allowed(error):
     '''
     Handles 405 error (method not allowed)
     '''
+    if request.path.startswith(api.url_prefix + "/"):
+        return api_error(error)
     return render_template('/errors/405.html'), 405
 
 
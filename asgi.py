@@ -0,0 +1,29 @@
+"""ASGI entry point for the app.
+
+Serves the same Flask app (routes, templates and validation.py checks) from
+an ASGI server such as uvicorn. The server's event loop handles reading
+requests from and writing responses to clients, so slow clients don't each
+hold a thread. Once a whole request has arrived, the view runs on a pool of
+ASGI_THREADS threads, so that many requests are handled at once in each
+process, the same as a gunicorn worker's threads.
+
+The views are still synchronous and MongoDB is still queried with PyMongo,
+so a request holds its thread while it waits for the database. The pool
+only frees the event loop from slow clients.
+
+The synchronous mode (python app.py) still works as before. Run this mode
+with:
+
+    uvicorn asgi:application --host 0.0.0.0 --port 5000 --proxy-headers
+"""
+
+
+import os
+
+from uvicorn.middleware.wsgi import WSGIMiddleware
+
+from app import app
+
+
+application = WSGIMiddleware(
+    app, workers=int(os.environ.get("ASGI_THREADS", 16)))
@@ -0,0 +1,201 @@
+"""This program builds and serves the static files (CSS, JavaScript, images).
+
+The build minifies the CSS and JavaScript, adds a hash of each file's content
+to its name (style.css becomes style.<hash>.css) and saves gzip and, if the
+brotli package is installed, brotli compressed copies of the text files. The
+built files are written to static/dist with a manifest.json listing them.
+Build them with:
+
+    python assets.py
+
+When a manifest exists, url_for('static', filename=...) links to the built
+file instead of the original. A built file's name changes whenever its
+content does, so browsers are told to keep them for a year, and the
+compressed copy is sent to browsers that accept it. Without a manifest the
+original files are served as before.
+"""
+
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+
+from flask import current_app, request, send_from_directory
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+BUILD_FOLDER = "dist"
+MANIFEST = "manifest.json"
+
+# Files worth compressing, images are already compressed
+COMPRESSIBLE = (".css", ".js", ".ico", ".svg", ".txt")
+
+# Content encodings in order of preference, with the file suffix used
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+CSS_URL = re.compile(r"""url\((['"]?)/static/([^'")]+)\1\)""")
+
+
+def minify_css(text):
+    """
+    Removes comments and the whitespace that isn't needed from CSS.
+    """
+
+    text = re.sub(r"/\*.*?\*/", "", text, flags=re.S)
+    text = re.sub(r"\s+", " ", text)
+    text = re.sub(r"\s*([{};,>])\s*", r"\1", text)
+    text = re.sub(r":\s+", ":", text)
+    return text.replace(";}", "}").strip()
+
+
+def minify_js(text):
+    """
+    Removes indentation, blank lines and whole line comments from
+    JavaScript. Line breaks are kept, as statements may rely on them.
+    """
+
+    lines = (line.strip() for line in text.splitlines())
+    return "\n".join(
+        line for line in lines if line and not line.startswith("//"))
+
+
+def fingerprinted(path, data):
+    """
+    Returns path with a hash of data added before the file extension.
+    """
+
+    stem, extension = os.path.splitext(path)
+    return "{}.{}{}".format(
+        stem, hashlib.md5(data).hexdigest()[:10], extension)
+
+
+def source_files(static_folder):
+    """
+    Returns the paths (relative to static_folder) of the files to build.
+    CSS is built last so it can link to the built images.
+    """
+
+    paths = []
+    for folder, folders, files in os.walk(static_folder):
+        relative = os.path.relpath(folder, static_folder)
+        if relative == BUILD_FOLDER:
+            folders.clear()
+            continue
+        for name in files:
+            paths.append(os.path.normpath(os.path.join(relative, name))
+                         .replace(os.sep, "/"))
+    return sorted(paths, key=lambda path: (path.endswith(".css"), path))
+
+
+def build(static_folder="static"):
+    """
+    Builds every file in static_folder into static_folder/dist and writes
+    the manifest. Returns the manifest.
+    """
+
+    output = os.path.join(static_folder, BUILD_FOLDER)
+    shutil.rmtree(output, ignore_errors=True)
+    manifest = {"files": {}, "encodings": {}}
+
+    for path in source_files(static_folder):
+        with open(os.path.join(static_folder, path), "rb") as file:
+            data = file.read()
+        if path.endswith(".css"):
+            text = CSS_URL.sub(lambda match: "url(/static/{})".format(
+                manifest["files"].get(match.group(2), match.group(2))),
+                data.decode())
+            data = minify_css(text).encode()
+        elif path.endswith(".js"):
+            data = minify_js(data.decode()).encode()
+
+        built = "{}/{}".format(BUILD_FOLDER, fingerprinted(path, data))
+        target = os.path.join(static_folder, built)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, "wb") as file:
+            file.write(data)
+        manifest["files"][path] = built
+
+        if path.endswith(COMPRESSIBLE):
+            compressed = {"gzip": gzip.compress(data, 9, mtime=0)}
+            if brotli:
+                compressed["br"] = brotli.compress(data)
+            manifest["encodings"][built] = []
+            for encoding, suffix in ENCODINGS:
+                if len(compressed.get(encoding, data)) < len(data):
+                    with open(target + suffix, "wb") as file:
+                        file.write(compressed[encoding])
+                    manifest["encodings"][built].append(encoding)
+
+    with open(os.path.join(output, MANIFEST), "w") as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    return manifest
+
+
+class Assets:
+    """
+    Links to and serves the built static files listed in the manifest.
+    """
+
+    def __init__(self, app=None):
+        self.files = {}
+        self.encodings = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.static_folder = app.static_folder
+        path = os.path.join(app.static_folder, BUILD_FOLDER, MANIFEST)
+        if os.path.exists(path):
+            with open(path) as file:
+                manifest = json.load(file)
+            self.files = manifest["files"]
+            self.encodings = manifest["encodings"]
+        app.url_defaults(self.link_built)
+        app.view_functions["static"] = self.send_static
+
+    def link_built(self, endpoint, values):
+        """
+        Swaps the filename in url_for('static') for the built file's name.
+        """
+
+        if endpoint == "static" and values.get("filename") in self.files:
+            values["filename"] = self.files[values["filename"]]
+
+    def send_static(self, filename):
+        """
+        Serves a static file. Built files are cached for a year and the
+        smallest copy the browser accepts is sent.
+        """
+
+        if not filename.startswith(BUILD_FOLDER + "/"):
+            return current_app.send_static_file(filename)
+
+        path, content_encoding = filename, None
+        for encoding, suffix in ENCODINGS:
+            if (encoding in self.encodings.get(filename, ())
+                    and request.accept_encodings[encoding]):
+                path, content_encoding = filename + suffix, encoding
+                break
+
+        response = send_from_directory(
+            self.static_folder, path,
+            mimetype=mimetypes.guess_type(filename)[0])
+        if content_encoding:
+            response.headers["Content-Encoding"] = content_encoding
+        response.vary.add("Accept-Encoding")
+        response.headers["Cache-Control"] = (
+            "public, max-age=31536000, immutable")
+        return response
+
+
+if __name__ == "__main__":
+    manifest = build(os.path.join(os.path.dirname(__file__) or ".", "static"))
+    print("Built {} static files".format(len(manifest["files"])))
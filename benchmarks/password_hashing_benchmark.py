@@ -0,0 +1,61 @@
+"""Benchmark for login password checks against hashing pool size.
+
+Simulates a burst of logins, each checking a password on its own request
+thread, and reports how many logins per second get through for different
+numbers of hashing worker processes. A pool size of 0 hashes on the request
+threads, like the app did before hashing.py.
+
+Run with:
+
+    python benchmarks/password_hashing_benchmark.py --pools 0,1,2,4
+"""
+
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from hashing import PasswordHasher  # noqa: E402
+
+
+def logins_per_second(hasher, pwhash, logins, threads):
+    """
+    Returns how many password checks per second complete when logins checks
+    are made from threads request threads at once.
+    """
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as requests:
+        results = list(requests.map(
+            lambda _: hasher.check(pwhash, "Passw0rd!"), range(logins)))
+    elapsed = time.perf_counter() - start
+    assert all(results)
+    return logins / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pools", default="0,1,2,4",
+                        help="comma separated hashing pool sizes")
+    parser.add_argument("--logins", type=int, default=64)
+    parser.add_argument("--threads", type=int, default=16,
+                        help="request threads making logins at once")
+    parser.add_argument("--iterations", type=int, default=150000)
+    args = parser.parse_args()
+
+    print("{:>6} {:>14}".format("pool", "logins/sec"))
+    for workers in [int(pool) for pool in args.pools.split(",")]:
+        hasher = PasswordHasher(iterations=args.iterations, workers=workers,
+                                max_pending=args.threads)
+        pwhash = hasher.hash("Passw0rd!")
+        # Warms up the worker processes before timing
+        hasher.check(pwhash, "Passw0rd!")
+        rate = logins_per_second(hasher, pwhash, args.logins, args.threads)
+        print("{:>6} {:>14.1f}".format(workers, rate))
+
+
+if __name__ == "__main__":
+    main()
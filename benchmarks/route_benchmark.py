@@ -0,0 +1,283 @@
+"""Benchmark suite for the app's busiest routes.
+
+Seeds a throwaway database with users and recipes, then drives the real
+Flask routes through Flask's test client and records, for each route, the
+throughput, p50 and p99 latency and the number of MongoDB commands sent per
+request. Results are written to a JSON file which can be passed back in as
+a baseline to compare a later run against.
+
+Run against a local MongoDB:
+
+    python benchmarks/route_benchmark.py --output before.json
+    python benchmarks/route_benchmark.py --baseline before.json
+
+Or against an in memory stand-in, if the mongomock package is installed:
+
+    python benchmarks/route_benchmark.py --mongomock
+
+mongomock doesn't support text search or command monitoring, so with it
+the search route is skipped and MongoDB commands aren't counted. Set
+CACHE_TTL=0 to measure the routes without the recipe cache.
+"""
+
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+from flask.testing import FlaskClient
+
+
+MEALS = ["Breakfast", "Lunch", "Dinner", "Desserts"]
+WORDS = ["tofu", "chickpea", "lentil", "avocado", "mushroom", "spinach",
+         "coconut", "oat", "banana", "tomato", "pasta", "curry", "soup"]
+PASSWORD = "Passw0rd!"
+# The app redirects http requests to https, so requests are sent to this
+BASE_URL = "https://localhost"
+
+
+def load_app(args):
+    """
+    Imports app.py pointed at the benchmark database and returns it.
+    """
+
+    os.environ["MONGO_URI"] = args.uri.rstrip("/") + "/" + args.database
+    os.environ.setdefault("SECRET_KEY", "benchmark")
+    os.environ.setdefault("PASSWORD_HASH_ITERATIONS", "150000")
+    os.environ.setdefault("RATE_LIMIT_ENABLED", "false")
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+    import app
+
+    if args.mongomock:
+        import mongomock
+
+        db = mongomock.MongoClient()[args.database]
+        app.mongo.db = db
+        app.recipes_data = db.recipes
+        app.users_data = db.users
+        app.subscribers_data = db.subscribers
+        app.summary_data = db.recipe_summary
+    return app
+
+
+def seed(app, users, recipes):
+    """
+    Inserts users and recipes in batches and returns the seeded usernames
+    and recipe ids.
+    """
+
+    app.mongo.db.client.drop_database(app.mongo.db.name)
+    rng = random.Random(1)
+
+    recipe_ids = []
+    batch = []
+    for n in range(recipes):
+        words = rng.sample(WORDS, 3)
+        batch.append({
+            "meal_name": rng.choice(MEALS),
+            "recipe_name": "{} {} {}".format(*words).title(),
+            "ingredients": "\n".join(rng.sample(WORDS, 8)),
+            "description": "A {} and {} dish".format(*words[:2]),
+            "recommendation": "",
+            "yield": "2",
+            "active_time": "10 Minutes",
+            "total_time": "30 Minutes",
+            "img_url": "",
+            "method": "\n".join("Step {}".format(i) for i in range(10)),
+            "created_by": "user{}".format(n % max(users, 1)),
+            "date_created": "01/01/2021",
+        })
+        if len(batch) == 1000:
+            recipe_ids += app.recipes_data.insert_many(batch).inserted_ids
+            batch = []
+    if batch:
+        recipe_ids += app.recipes_data.insert_many(batch).inserted_ids
+
+    pwhash = app.hasher.hash(PASSWORD)
+    usernames = ["user{}".format(n) for n in range(users)]
+    app.users_data.insert_many([{
+        "username": username,
+        "email": "{}@example.com".format(username),
+        "password": pwhash,
+        "date_joined": "01/01/2021",
+        "profile_image": app.default_pic,
+        "saved_recipes": rng.sample(recipe_ids, min(20, len(recipe_ids))),
+    } for username in usernames])
+    return usernames, recipe_ids
+
+
+def scenarios(app, usernames, recipe_ids, skip_search):
+    """
+    Returns (name, endpoint, user, status, make_request) for each route
+    benchmarked. make_request takes the test client and sends one request,
+    which must return status.
+    """
+
+    rng = random.Random(2)
+
+    def save_toggle(client):
+        recipe_id = rng.choice(recipe_ids)
+        client.post("/save/{}".format(recipe_id))
+        return client.post("/saved-recipes/remove/{}".format(recipe_id))
+
+    listed = [
+        ("recipes", "recipes", None, 200,
+         lambda client: client.get("/recipes")),
+        ("meals", "meals", None, 200,
+         lambda client: client.get("/recipes/" + rng.choice(MEALS).lower())),
+        ("search", "search", None, 200,
+         lambda client: client.post("/recipes", data={
+             "search-query": rng.choice(WORDS)})),
+        ("recipe_page", "recipe_page", None, 200,
+         lambda client: client.get(
+             "/recipe/{}".format(rng.choice(recipe_ids)))),
+        ("login", "login", None, 302,
+         lambda client: client.post("/login", data={
+             "username": rng.choice(usernames), "password": PASSWORD})),
+        ("save_unsave", "remove_saved_recipe", usernames[0], 302,
+         save_toggle),
+        ("saved_recipes", "saved_recipes", usernames[0], 200,
+         lambda client: client.get("/saved-recipes")),
+    ]
+    return [scenario for scenario in listed
+            if not (skip_search and scenario[0] == "search")]
+
+
+def check_status(endpoint, response, status):
+    if response.status_code != status:
+        raise RuntimeError("{} returned {}, expected {}".format(
+            endpoint, response.status_code, status))
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1,
+                             int(len(sorted_values) * fraction))]
+
+
+class SecureClient(FlaskClient):
+    """
+    Test client that sends every request over https, so Flask-SSLify
+    doesn't redirect it.
+    """
+
+    def open(self, *args, **kwargs):
+        kwargs.setdefault("base_url", BASE_URL)
+        return super().open(*args, **kwargs)
+
+
+def run_scenario(app, endpoint, user, status, make_request, requests,
+                 count_commands=True):
+    """
+    Sends requests requests one after another and returns the results.
+    Stops with an error if a response doesn't have the expected status.
+    """
+
+    client = SecureClient(app.app, app.app.response_class, use_cookies=True)
+    if user:
+        with client.session_transaction(base_url=BASE_URL) as session:
+            session["user"] = user
+
+    check_status(endpoint, make_request(client), status)
+    count_before, commands_before = app.request_metrics.totals(endpoint)
+
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(requests):
+        request_start = time.perf_counter()
+        response = make_request(client)
+        latencies.append(time.perf_counter() - request_start)
+        check_status(endpoint, response, status)
+    elapsed = time.perf_counter() - start
+
+    count_after, commands_after = app.request_metrics.totals(endpoint)
+    handled = count_after - count_before
+    latencies.sort()
+    return {
+        "requests": requests,
+        "throughput_rps": round(requests / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "mongo_ops_per_request": (
+            round((commands_after - commands_before) / handled, 2)
+            if handled and count_commands else None),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints each route's change from the baseline and returns True if any
+    route's p99 latency got worse by more than tolerance percent.
+    """
+
+    regressed = False
+    print("\n{:<15} {:>12} {:>12} {:>9}".format(
+        "route", "p99 before", "p99 after", "change"))
+    for name, result in results.items():
+        before = baseline.get(name)
+        if not before:
+            continue
+        change = (result["p99_ms"] - before["p99_ms"]) / before["p99_ms"] * 100
+        regressed = regressed or change > tolerance
+        print("{:<15} {:>12.2f} {:>12.2f} {:>+8.1f}%".format(
+            name, before["p99_ms"], result["p99_ms"], change))
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--uri", default="mongodb://localhost:27017")
+    parser.add_argument("--database", default="eating_vegan_benchmark")
+    parser.add_argument("--mongomock", action="store_true",
+                        help="use an in memory stand-in for MongoDB")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--recipes", type=int, default=5000)
+    parser.add_argument("--requests", type=int, default=200,
+                        help="requests sent to each route")
+    parser.add_argument("--output", default="benchmark-results.json")
+    parser.add_argument("--baseline",
+                        help="results file from an earlier run to compare to")
+    parser.add_argument("--tolerance", type=float, default=10,
+                        help="p99 increase in percent counted as a regression")
+    args = parser.parse_args()
+
+    app = load_app(args)
+    usernames, recipe_ids = seed(app, args.users, args.recipes)
+
+    results = {}
+    print("{:<15} {:>10} {:>9} {:>9} {:>10}".format(
+        "route", "req/s", "p50 ms", "p99 ms", "mongo ops"))
+    try:
+        for name, endpoint, user, status, make_request in scenarios(
+                app, usernames, recipe_ids, skip_search=args.mongomock):
+            result = run_scenario(
+                app, endpoint, user, status, make_request, args.requests,
+                count_commands=not args.mongomock)
+            results[name] = result
+            print("{:<15} {:>10} {:>9} {:>9} {:>10}".format(
+                name, result["throughput_rps"], result["p50_ms"],
+                result["p99_ms"], str(result["mongo_ops_per_request"])))
+    finally:
+        app.mongo.db.client.drop_database(app.mongo.db.name)
+
+    with open(args.output, "w") as output:
+        json.dump({
+            "users": args.users,
+            "recipes": args.recipes,
+            "mongomock": args.mongomock,
+            "results": results,
+        }, output, indent=2)
+    print("\nResults written to {}".format(args.output))
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            if compare(results, json.load(baseline)["results"],
+                       args.tolerance):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Benchmark for loading a users saved recipes.
+
+Compares the old way of loading saved recipes (one find_one per saved id)
+with the batched way used by saved_recipes() in app.py (one "$in" query),
+for users with different numbers of saved recipes.
+
+Run against a local MongoDB with:
+
+    python benchmarks/saved_recipes_benchmark.py --uri mongodb://localhost
+
+A throwaway database is created for the run and dropped afterwards.
+"""
+
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+from pymongo import MongoClient
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from pagination import CARD_FIELDS  # noqa: E402
+
+
+def seed(db, total_recipes):
+    """
+    Inserts recipes with long ingredients and method text, like real ones.
+    Returns the inserted recipe ids.
+    """
+
+    recipes = [{
+        "meal_name": "Dinner",
+        "recipe_name": "Recipe {}".format(n),
+        "description": "A tasty vegan dinner",
+        "ingredients": "\n".join("Ingredient {}".format(i)
+                                 for i in range(20)),
+        "method": "\n".join("Step {}".format(i) for i in range(15)),
+        "img_url": "",
+        "created_by": "bench",
+    } for n in range(total_recipes)]
+    return db.recipes.insert_many(recipes).inserted_ids
+
+
+def load_one_by_one(db, saved):
+    """
+    The old saved_recipes() lookup, one round trip per saved recipe.
+    """
+
+    return [db.recipes.find_one({"_id": recipe_id}) for recipe_id in saved]
+
+
+def load_batched(db, saved):
+    """
+    The new saved_recipes() lookup, one round trip for all saved recipes.
+    """
+
+    found = {recipe["_id"]: recipe for recipe in db.recipes.find(
+        {"_id": {"$in": saved}}, CARD_FIELDS)}
+    return [found[recipe_id] for recipe_id in saved if recipe_id in found]
+
+
+def time_ms(func, db, saved, repeat):
+    """
+    Returns the median time in milliseconds of calling func repeat times.
+    """
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(db, saved)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--uri", default=os.environ.get(
+        "MONGO_URI", "mongodb://localhost:27017"))
+    parser.add_argument("--sizes", default="10,50,100,300",
+                        help="comma separated saved list sizes")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    client = MongoClient(args.uri)
+    db = client["eating_vegan_benchmark"]
+    db.recipes.drop()
+
+    try:
+        ids = seed(db, max(sizes))
+        print("{:>8} {:>14} {:>14}".format(
+            "saved", "before (ms)", "after (ms)"))
+        for size in sizes:
+            saved = list(ids[:size])
+            before = time_ms(load_one_by_one, db, saved, args.repeat)
+            after = time_ms(load_batched, db, saved, args.repeat)
+            print("{:>8} {:>14.2f} {:>14.2f}".format(size, before, after))
+    finally:
+        client.drop_database(db)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""Load test for the ways of running the app with slow clients.
+
+Opens many connections at once, each sending its request slowly like a
+client on a poor mobile connection, and reports throughput and latency.
+This measures how each server copes with slow connections, not database
+concurrency: in every mode the views and their MongoDB queries run on
+threads. Run it once against each mode and compare the results:
+
+    python app.py
+    python benchmarks/slow_clients_benchmark.py --url http://localhost:5000/
+
+    uvicorn asgi:application --port 5000
+    python benchmarks/slow_clients_benchmark.py --url http://localhost:5000/
+"""
+
+
+import argparse
+import asyncio
+import statistics
+import time
+from urllib.parse import urlsplit
+
+
+async def slow_request(host, port, path, delay):
+    """
+    Sends a GET request one header line at a time, waiting delay seconds
+    between lines, and returns the response status code and latency.
+    """
+
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection(host, port)
+    lines = [
+        "GET {} HTTP/1.1".format(path),
+        "Host: {}".format(host),
+        "X-Forwarded-Proto: https",
+        "Connection: close",
+    ]
+    for line in lines:
+        writer.write((line + "\r\n").encode())
+        await writer.drain()
+        await asyncio.sleep(delay)
+    writer.write(b"\r\n")
+    await writer.drain()
+
+    status_line = await reader.readline()
+    await reader.read()
+    writer.close()
+    return int(status_line.split()[1]), time.perf_counter() - start
+
+
+async def run(url, clients, requests, delay):
+    parts = urlsplit(url)
+    host, port = parts.hostname, parts.port or 80
+    path = parts.path or "/"
+    semaphore = asyncio.Semaphore(clients)
+
+    async def client():
+        async with semaphore:
+            try:
+                return await slow_request(host, port, path, delay)
+            except OSError:
+                return None, None
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*[client() for _ in range(requests)])
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for status, latency in results
+                       if status is not None and status < 500)
+    errors = len(results) - len(latencies)
+    print("requests:      {}".format(requests))
+    print("errors:        {}".format(errors))
+    print("throughput:    {:.1f} req/s".format(len(latencies) / elapsed))
+    if latencies:
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        print("p50 latency:   {:.0f} ms".format(
+            statistics.median(latencies) * 1000))
+        print("p99 latency:   {:.0f} ms".format(p99 * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://localhost:5000/")
+    parser.add_argument("--clients", type=int, default=200,
+                        help="connections open at once")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--delay", type=float, default=0.1,
+                        help="seconds between each header line sent")
+    args = parser.parse_args()
+    asyncio.run(run(args.url, args.clients, args.requests, args.delay))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""Benchmark for form validation throughput.
+
+Compares the old password and username checks (one pass over the password
+for each character rule, stopping at the first failure) with first_errors()
+from validation.py, which the forms now use and which also stops at the
+first failure, and with validate_many(), which carries on to find every
+error and is used by the recipe import. Records are a mix of valid and
+invalid registrations and recipes, and registrations that are all valid.
+
+Run with:
+
+    python benchmarks/validation_benchmark.py --records 10000
+"""
+
+
+import argparse
+import os
+import random
+import statistics
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from validation import (  # noqa: E402
+    REGISTRATION_RULES, RECIPE_RULES, first_errors, validate_many)
+
+
+def old_registration_error(record):
+    """
+    The checks valid_registration() made before validation.py had rules,
+    returning the first error instead of flashing it.
+    """
+
+    password, username = record["password"], record["username"]
+    symbols = ['!', '@', '#', '$', '%', '^', '&', '*']
+    if len(password) < 5:
+        return 'Password must be at least 5 characters.'
+    if len(password) > 15:
+        return 'Password should not exceed 15 characters.'
+    if not any(char.islower() for char in password):
+        return 'Password should have at least one lowercase letter.'
+    if not any(char.isupper() for char in password):
+        return 'Password should have at least one uppercase letter.'
+    if not any(char.isdigit() for char in password):
+        return 'Password should have at least one number.'
+    if not any(char in symbols for char in password):
+        return 'Password should include at least one symbol: !@#$%^&* '
+    if len(username) < 5:
+        return 'Username must be at least 5 characters.'
+    if len(username) > 15:
+        return 'Username cant be longer than 15 characters.'
+    return None
+
+
+def old_recipe_error(record):
+    """
+    The checks valid_recipe() made before validation.py had rules.
+    """
+
+    if len(record["description"]) > 100:
+        return "Description"
+    elif len(record["recipe_name"]) > 35:
+        return "Recipe name"
+    elif len(record["recommendation"]) > 100:
+        return "Recommendation"
+    return None
+
+
+def registrations(count):
+    alphabet = string.ascii_letters + string.digits + "!@#$%^&*"
+    return [{
+        "username": "".join(random.choices(string.ascii_lowercase,
+                                           k=random.randint(3, 17))),
+        "password": "".join(random.choices(alphabet,
+                                           k=random.randint(3, 17))),
+    } for _ in range(count)]
+
+
+def valid_registrations(count):
+    """
+    Registrations that pass every check, the slowest case for the old
+    checks as they look at each password once per character rule.
+    """
+
+    return [{
+        "username": "vegan{}".format(n),
+        "password": "Tofu{}!{}".format(n % 97, "x" * (n % 5)),
+    } for n in range(count)]
+
+
+def recipes(count):
+    return [{
+        "description": "x" * random.randint(20, 120),
+        "recipe_name": "y" * random.randint(5, 40),
+        "recommendation": "z" * random.randint(0, 110),
+    } for _ in range(count)]
+
+
+def records_per_second(func, records, repeat):
+    """
+    Returns the median number of records func checks per second.
+    """
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(records)
+        timings.append(time.perf_counter() - start)
+    return len(records) / statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--records", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    cases = [
+        ("registration", registrations(args.records),
+         old_registration_error, REGISTRATION_RULES),
+        ("valid reg.", valid_registrations(args.records),
+         old_registration_error, REGISTRATION_RULES),
+        ("recipe", recipes(args.records), old_recipe_error, RECIPE_RULES),
+    ]
+
+    print("{:>14} {:>18} {:>18} {:>18}".format(
+        "records", "before (rec/s)", "first error", "every error"))
+    for name, records, old, rules in cases:
+        before = records_per_second(
+            lambda batch: [old(record) for record in batch],
+            records, args.repeat)
+        first = records_per_second(
+            lambda batch: first_errors(batch, rules), records, args.repeat)
+        every = records_per_second(
+            lambda batch: validate_many(batch, rules), records, args.repeat)
+        print("{:>14} {:>18,.0f} {:>18,.0f} {:>18,.0f}".format(
+            name, before, first, every))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""This program includes the cache used in front of recipe reads.
+
+Recipes change far less often than they are read, so single recipes and
+pages of recipe listings are cached for a short time (CACHE_TTL seconds).
+The cache is stored in memory by default and holds at most CACHE_MAX_SIZE
+entries, dropping the least recently used first. If CACHE_REDIS_URL is set
+the cache is stored in Redis instead, so that every worker process sees the
+same entries and invalidations.
+
+Listing pages are stored under a namespace (for example all the pages of
+one meal). Invalidating a namespace bumps its version number, which makes
+every page cached under the old version unreachable at once.
+"""
+
+
+import threading
+import time
+from collections import OrderedDict
+
+import bson
+
+
+# Returned by backends when a key is not cached
+MISSING = object()
+
+
+class MemoryBackend:
+    """
+    Cache stored in this process, bounded in size with least recently used
+    entries dropped first.
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return MISSING
+            value, expires = item
+            if expires < time.monotonic():
+                del self._items[key]
+                return MISSING
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._items[key] = (value, time.monotonic() + ttl)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._items.pop(key, None)
+
+    def touch(self, key, ttl):
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                self._items[key] = (item[0], time.monotonic() + ttl)
+
+    def version(self, namespace):
+        return self._versions.get(namespace, 0)
+
+    def bump(self, namespace):
+        with self._lock:
+            self._versions[namespace] = self._versions.get(namespace, 0) + 1
+
+
+class RedisBackend:
+    """
+    Cache stored in Redis and shared by every worker process.
+    Values are stored as BSON so ObjectIds survive the round trip.
+    Needs the redis package, which is only imported when this is used.
+    """
+
+    def __init__(self, url, prefix="eating-vegan:"):
+        import redis
+
+        self._redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        data = self._redis.get(self.prefix + key)
+        if data is None:
+            return MISSING
+        return bson.decode(data)["value"]
+
+    def set(self, key, value, ttl):
+        self._redis.set(
+            self.prefix + key, bson.encode({"value": value}), ex=ttl)
+
+    def delete(self, *keys):
+        """
+        Deletes keys with one DEL command for each 1000 keys, instead of a
+        round trip to Redis for each key.
+        """
+
+        keys = [self.prefix + key for key in keys]
+        for start in range(0, len(keys), 1000):
+            self._redis.delete(*keys[start:start + 1000])
+
+    def touch(self, key, ttl):
+        self._redis.expire(self.prefix + key, ttl)
+
+    def version(self, namespace):
+        return int(self._redis.get(self.prefix + "version:" + namespace) or 0)
+
+    def bump(self, namespace):
+        self._redis.incr(self.prefix + "version:" + namespace)
+
+
+def make_backend(config):
+    """
+    Returns a Redis backend if CACHE_REDIS_URL is set, otherwise an
+    in memory backend.
+    """
+
+    if config.get("CACHE_REDIS_URL"):
+        return RedisBackend(config["CACHE_REDIS_URL"])
+    return MemoryBackend(config.get("CACHE_MAX_SIZE", 1024))
+
+
+class RecipeCache:
+    """
+    Read through cache that counts hits and misses.
+    """
+
+    def __init__(self, backend, ttl=60):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get_or_load(self, key, load):
+        """
+        Returns the cached value for key, or calls load and caches the result.
+        """
+
+        value = self.backend.get(key)
+        if value is not MISSING:
+            with self._lock:
+                self.hits += 1
+            return value
+
+        with self._lock:
+            self.misses += 1
+        value = load()
+        self.backend.set(key, value, self.ttl)
+        return value
+
+    def namespaced(self, namespace, key):
+        """
+        Returns the key for an entry stored under the current version of
+        namespace.
+        """
+
+        return "{}:{}:{}".format(
+            namespace, self.backend.version(namespace), key)
+
+    def invalidate(self, *keys):
+        if keys:
+            self.backend.delete(*keys)
+
+    def invalidate_namespace(self, *namespaces):
+        for namespace in namespaces:
+            self.backend.bump(namespace)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
@@ -0,0 +1,144 @@
+"""This program includes the HTTP caching helpers for recipe pages.
+
+Every recipe has a version number, increased each time it is edited, and
+an updated_at time. Recipe and listing pages send an ETag built from the
+versions of the recipes they show and a Last-Modified time, so browsers and
+CDNs can ask if their copy is still current. If it is, a 304 (not modified)
+response is sent without rendering the page.
+
+ETags also include the build version (see build_version()), so pages
+cached before a deploy that changed templates or static files are sent
+again, with links to the new static files. For the same reason a page is
+never older than the deploy (see build_time()) when checking
+If-Modified-Since.
+
+Pages for logged out users are marked public so a CDN can cache them for
+PAGE_MAX_AGE seconds. Pages for logged in users, or with flash messages
+waiting to be shown, are marked private.
+"""
+
+
+import hashlib
+import os
+from datetime import datetime
+
+from flask import current_app, make_response, request, session
+
+
+def recipe_version(recipe):
+    """
+    Returns the version and last modified time of a recipe.
+    Recipes saved before versions were added count as version 0, last
+    modified when they were created.
+    """
+
+    updated = recipe.get("updated_at") or (
+        recipe["_id"].generation_time.replace(tzinfo=None))
+    return recipe.get("version", 0), updated.replace(microsecond=0)
+
+
+def build_version(app):
+    """
+    Returns the version of the deployed code: the commit from Heroku's
+    HEROKU_SLUG_COMMIT if set, otherwise a hash of the templates and the
+    static files manifest, which change whenever a page's HTML can.
+    """
+
+    if os.environ.get("HEROKU_SLUG_COMMIT"):
+        return os.environ["HEROKU_SLUG_COMMIT"]
+
+    digest = hashlib.md5()
+    paths = [os.path.join(app.static_folder, "dist", "manifest.json")]
+    for folder, _, names in sorted(os.walk(os.path.join(
+            app.root_path, app.template_folder))):
+        paths += [os.path.join(folder, name) for name in sorted(names)]
+    for path in paths:
+        try:
+            with open(path, "rb") as file:
+                digest.update(os.path.relpath(path, app.root_path).encode()
+                              + file.read())
+        except FileNotFoundError:
+            continue
+    return digest.hexdigest()
+
+
+def build_time():
+    """
+    Returns when the deployed code was released: Heroku's
+    HEROKU_RELEASE_CREATED_AT if set, otherwise now, as this is called when
+    the app starts.
+    """
+
+    if os.environ.get("HEROKU_RELEASE_CREATED_AT"):
+        return datetime.strptime(
+            os.environ["HEROKU_RELEASE_CREATED_AT"], "%Y-%m-%dT%H:%M:%SZ")
+    return datetime.utcnow().replace(microsecond=0)
+
+
+def page_etag(recipes, user, extra="", build=""):
+    """
+    Returns an ETag for a page showing recipes to user, built by build.
+    extra is anything else shown on the page that should change the ETag
+    when it changes.
+    """
+
+    parts = ["{}:{}".format(recipe["_id"], recipe_version(recipe)[0])
+             for recipe in recipes]
+    parts += [user, extra, build]
+    return hashlib.md5(",".join(parts).encode()).hexdigest()
+
+
+def not_modified(etag, last_modified):
+    """
+    Checks if the client's cached copy of the page is still current.
+    If-None-Match is checked first, as it also notices recipes being removed
+    from a page, which If-Modified-Since can't.
+    """
+
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since and last_modified:
+        return last_modified <= request.if_modified_since
+    return False
+
+
+def cached_page(recipes, render, max_age=60, extra=""):
+    """
+    Returns the response from render() with caching headers for a page
+    showing recipes, or a 304 response without calling render() if the
+    client's copy is current.
+    """
+
+    # Flash messages are only shown once, so the page has to be rendered
+    if session.get("_flashes"):
+        response = make_response(render())
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+
+    recipes = [recipe for recipe in recipes if recipe]
+    user = session.get("user", "")
+    etag = page_etag(recipes, user, extra,
+                     current_app.config.get("BUILD_VERSION", ""))
+    last_modified = max(
+        (recipe_version(recipe)[1] for recipe in recipes), default=None)
+    # Pages cached before a deploy may use old templates or static files
+    if last_modified and current_app.config.get("BUILD_TIME"):
+        last_modified = max(last_modified, current_app.config["BUILD_TIME"])
+
+    if not_modified(etag, last_modified):
+        response = make_response("", 304)
+    else:
+        response = make_response(render())
+
+    response.set_etag(etag, weak=True)
+    if last_modified:
+        response.last_modified = last_modified
+    if user:
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    else:
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+    response.vary.add("Cookie")
+    return response
@@ -0,0 +1,57 @@
+"""This program includes the cache of rendered recipe fragments.
+
+Recipe cards (on the recipes, saved recipes, profile and home pages) and the
+body of the recipe page are the same for every user who sees them, so each
+is rendered once and the HTML reused. This also means a recipe's
+ingredients and method are only split into lists once per version.
+
+Fragments are keyed by recipe id and version, so an edited recipe is never
+shown from a stale fragment, even by a worker that didn't make the edit.
+Fragments are cached in each process because they are cheap to keep and
+are used many times per page.
+
+Fragment templates are in templates/fragments and must not use the session,
+as the same HTML is shown to every user. Anything that changes per user is
+passed in as an option, which becomes part of the key.
+"""
+
+
+from flask import render_template
+from markupsafe import Markup
+
+from cache import MemoryBackend, MISSING
+from conditional import recipe_version
+
+
+class FragmentCache:
+    """
+    Renders fragment templates for a recipe, reusing earlier renders of
+    the same recipe version.
+    """
+
+    def __init__(self, max_size=4096, ttl=3600):
+        self.backend = MemoryBackend(max_size)
+        self.ttl = ttl
+
+    def render(self, template, recipe, **options):
+        recipe_id = str(recipe["_id"])
+        key = "{}:{}:{}:{}:{}".format(
+            template, recipe_id, self.backend.version(recipe_id),
+            recipe_version(recipe)[0], sorted(options.items()))
+
+        html = self.backend.get(key)
+        if html is MISSING:
+            html = render_template(template, recipe=recipe, **options)
+            self.backend.set(key, html, self.ttl)
+        return Markup(html)
+
+    def invalidate(self, *recipe_ids):
+        """
+        Drops every fragment of the given recipes.
+        """
+
+        for recipe_id in recipe_ids:
+            self.backend.bump(str(recipe_id))
+
+    def init_app(self, app):
+        app.jinja_env.globals["recipe_fragment"] = self.render
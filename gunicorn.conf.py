@@ -0,0 +1,66 @@
+"""Gunicorn settings for running the app in production.
+
+Runs several worker processes, each with several threads, so one slow
+request doesn't hold up the others. The app is loaded once before the
+workers are forked, with every template compiled, and each worker connects
+to MongoDB before it starts taking requests. Start it with:
+
+    gunicorn app:app -c gunicorn.conf.py
+
+Each setting can be changed with the environment variable next to it.
+"""
+
+
+import multiprocessing
+import os
+
+
+bind = "0.0.0.0:{}".format(os.environ.get("PORT", 5000))
+workers = int(os.environ.get(
+    "WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+worker_class = "gthread"
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 30))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", 5))
+preload_app = True
+# Trusts the X-Forwarded-* headers set by Heroku's router
+forwarded_allow_ips = "*"
+
+
+def when_ready(server):
+    """
+    Compiles the templates once, in the master process, before any workers
+    are forked, so every worker starts with them already compiled.
+    """
+
+    from app import compile_templates
+
+    server.log.info("Compiled %s templates", compile_templates())
+
+
+def post_worker_init(worker):
+    """
+    Connects the worker to MongoDB and checks the indexes before it accepts
+    any requests, see startup() in app.py. If MongoDB can't be reached the
+    worker still starts and tries again on its first request instead.
+    """
+
+    from app import startup
+
+    try:
+        startup()
+        worker.log.info("Worker %s ready", worker.pid)
+    except Exception as error:
+        worker.log.warning("Worker %s could not connect to MongoDB: %s",
+                           worker.pid, error)
+
+
+def worker_exit(server, worker):
+    """
+    Makes any writes still in the write-behind queue before the worker
+    exits, see writes.py.
+    """
+
+    from app import write_queue
+
+    write_queue.flush()
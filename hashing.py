@@ -0,0 +1,99 @@
+"""This program includes the password hashing service.
+
+Hashing a password is slow on purpose, so when lots of users log in at once
+hashing on the request thread holds up every other request. The hasher runs
+werkzeug's generate_password_hash and check_password_hash in a pool of
+worker processes instead, and caps how many hashes can be waiting at once so
+a burst of logins can't queue up without limit.
+
+The hash method (and so its cost) is configurable. Passwords hashed with an
+older method can be upgraded the next time the user logs in, see
+PasswordHasher.needs_rehash.
+"""
+
+
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class HashingBusy(Exception):
+    """
+    Raised when too many hashes are already waiting to run.
+    """
+
+
+class PasswordHasher:
+    """
+    Hashes and checks passwords in a pool of worker processes.
+    With workers set to 0 hashing runs on the calling thread.
+    """
+
+    def __init__(self, iterations=150000, salt_length=16, workers=2,
+                 max_pending=8, wait=10):
+        self.method = "pbkdf2:sha256:{}".format(iterations)
+        self.salt_length = salt_length
+        self.workers = workers
+        self.wait = wait
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def hash(self, password):
+        """
+        Returns a hash of password using the configured method.
+        """
+
+        return self._run(
+            generate_password_hash, password, self.method, self.salt_length)
+
+    def check(self, pwhash, password):
+        """
+        Checks password against a stored hash.
+        """
+
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """
+        Checks if a stored hash was made with a different method (for example
+        fewer iterations) than the one configured now.
+        """
+
+        return pwhash.split("$", 1)[0] != self.method
+
+    def _pool(self, broken=None):
+        """
+        Returns the process pool, creating it in the current process if
+        needed. The pool is never shared across a fork, so each gunicorn
+        worker gets its own. If broken is the current pool (one of its
+        processes died) it is replaced with a new one.
+        """
+
+        with self._lock:
+            if (self._executor is None or self._pid != os.getpid()
+                    or self._executor is broken):
+                if broken is not None and self._executor is broken:
+                    broken.shutdown(wait=False)
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                self._pid = os.getpid()
+            return self._executor
+
+    def _run(self, func, *args):
+        if not self._slots.acquire(timeout=self.wait):
+            raise HashingBusy()
+        try:
+            if not self.workers:
+                return func(*args)
+            pool = self._pool()
+            try:
+                return pool.submit(func, *args).result()
+            except BrokenProcessPool:
+                # A hashing process was killed, which breaks the whole pool
+                return self._pool(broken=pool).submit(func, *args).result()
+        finally:
+            self._slots.release()
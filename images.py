@@ -0,0 +1,333 @@
+"""This program includes the image pipeline for recipe and profile images.
+
+Recipe and profile images are links to images on other sites, often full
+size photos. Instead of sending every browser to those sites, each image is
+fetched once, resized to the size it is shown at and saved as WebP and JPEG
+thumbnails, which are served from /images with a long cache lifetime.
+
+Each thumbnail URL holds the image URL itself, signed with the app's secret
+key, so any worker on any dyno can serve it, even one that has never seen
+the image before or has just restarted with an empty cache. The signature
+stops the route being used to fetch images no page links to.
+
+Images are stored on disk under IMAGE_CACHE_DIR:
+
+    digests/<key>                   the digest of the image at a URL
+    sources/<digest>                the fetched image
+    variants/<digest>-<size>.<fmt>  the thumbnails
+
+where key is a hash of the image URL and digest a hash of the image itself,
+so the same image linked from two URLs is only stored once. When the cache
+grows past IMAGE_CACHE_MAX_MB the least recently used images are removed and
+fetched again if they are needed.
+
+Resizing needs Pillow. If it isn't installed the templates link to the
+original images as before.
+"""
+
+
+import hashlib
+import io
+import ipaddress
+import os
+import socket
+import tempfile
+import threading
+import time
+import urllib.request
+from urllib.parse import urlparse
+
+from flask import url_for
+from itsdangerous import BadSignature, URLSafeSerializer
+from markupsafe import Markup, escape
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+
+# Thumbnail sizes (width, height), twice the size they are shown at in
+# style.css so they are sharp on high density screens
+SIZES = {
+    "card": (700, 500),
+    "page": (1600, 900),
+    "profile-card": (900, 600),
+    "profile-photo": (400, 400),
+}
+
+# Thumbnail formats, with the Pillow format name and mimetype
+FORMATS = {
+    "webp": ("WEBP", "image/webp"),
+    "jpeg": ("JPEG", "image/jpeg"),
+}
+
+# Seconds before an image that couldn't be fetched is tried again
+RETRY_AFTER = 300
+
+
+class ImageError(Exception):
+    """
+    Raised when an image can't be fetched or resized.
+    """
+
+
+def check_url(url):
+    """
+    Raises ImageError unless url is an http(s) URL on a public host, so
+    image links can't be used to make the server request internal addresses.
+    """
+
+    parts = urlparse(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise ImageError("Not an http(s) URL: {}".format(url))
+    try:
+        addresses = socket.getaddrinfo(parts.hostname, None)
+    except (socket.gaierror, UnicodeError) as error:
+        raise ImageError("Could not resolve {}: {}".format(url, error))
+    for address in addresses:
+        if not ipaddress.ip_address(address[4][0].split("%")[0]).is_global:
+            raise ImageError("Not a public address: {}".format(url))
+
+
+class CheckedRedirects(urllib.request.HTTPRedirectHandler):
+    """
+    Checks the URL of every redirect before following it.
+    """
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        check_url(newurl)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+class UrlFetcher:
+    """
+    Fetches images over http(s). Any callable taking a URL and returning the
+    image bytes (or raising ImageError) can be used in its place.
+    """
+
+    def __init__(self, timeout=5, max_bytes=10 * 1024 * 1024):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.opener = urllib.request.build_opener(CheckedRedirects)
+
+    def __call__(self, url):
+        check_url(url)
+        request = urllib.request.Request(
+            url, headers={"User-Agent": "eating-vegan-images"})
+        try:
+            with self.opener.open(request, timeout=self.timeout) as response:
+                data = response.read(self.max_bytes + 1)
+        except (OSError, ValueError) as error:
+            raise ImageError("Could not fetch {}: {}".format(url, error))
+        if len(data) > self.max_bytes:
+            raise ImageError("Image too large: {}".format(url))
+        return data
+
+
+def write_file(path, data):
+    """
+    Writes data to path through a temporary file, so other threads and
+    workers never read a half written file.
+    """
+
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(handle, "wb") as temp:
+        temp.write(data)
+    os.replace(temp_path, path)
+
+
+class ImageStore:
+    """
+    Fetches, resizes and stores images in a directory, and renders the
+    <picture> tags that link to them.
+    """
+
+    def __init__(self, directory, fetcher=None, max_bytes=256 * 1024 * 1024,
+                 quality=80):
+        self.directory = directory
+        self.fetcher = fetcher or UrlFetcher()
+        self.max_bytes = max_bytes
+        self.quality = quality
+        self.enabled = Image is not None
+        self.failed = {}
+        self.size = None
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        self.serializer = None
+        for folder in ("digests", "sources", "variants"):
+            os.makedirs(os.path.join(directory, folder), exist_ok=True)
+
+    def path(self, folder, name):
+        return os.path.join(self.directory, folder, name)
+
+    @staticmethod
+    def key(url):
+        return hashlib.sha256(url.encode()).hexdigest()[:32]
+
+    def token(self, url):
+        """
+        Returns url signed, for use in an /images URL.
+        """
+
+        return self.serializer.dumps(url)
+
+    def source_url(self, token):
+        """
+        Returns the image URL in a token from token(). Raises KeyError if
+        the token wasn't signed with this app's secret key.
+        """
+
+        try:
+            return self.serializer.loads(token)
+        except BadSignature:
+            raise KeyError(token)
+
+    def digest(self, key):
+        """
+        Returns the digest of the image fetched for key, or None if it
+        hasn't been fetched by this machine.
+        """
+
+        try:
+            with open(self.path("digests", key), "rb") as file:
+                return file.read().decode() or None
+        except FileNotFoundError:
+            return None
+
+    def variant(self, url, size, fmt):
+        """
+        Returns the path of a thumbnail of the image at url, fetching and
+        resizing the image first if needed. Raises ImageError if the image
+        can't be fetched or resized.
+        """
+
+        key = self.key(url)
+        digest = self.digest(key)
+        if digest:
+            path = self.path("variants", "{}-{}.{}".format(digest, size, fmt))
+            try:
+                os.utime(path)
+                return path
+            except FileNotFoundError:
+                pass
+
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            if time.monotonic() < self.failed.get(key, 0):
+                raise ImageError("Recently failed: {}".format(url))
+            try:
+                return self.create_variant(url, key, size, fmt)
+            except ImageError:
+                self.failed[key] = time.monotonic() + RETRY_AFTER
+                raise
+            finally:
+                with self.lock:
+                    self.key_locks.pop(key, None)
+
+    def create_variant(self, url, key, size, fmt):
+        digest = self.digest(key)
+        source = digest and self.path("sources", digest)
+        if not (source and os.path.exists(source)):
+            data = self.fetcher(url)
+            digest = hashlib.sha256(data).hexdigest()[:32]
+            source = self.path("sources", digest)
+            write_file(source, data)
+            write_file(self.path("digests", key), digest.encode())
+            self.grow(len(data))
+
+        path = self.path("variants", "{}-{}.{}".format(digest, size, fmt))
+        if not os.path.exists(path):
+            thumbnail = self.resize(source, SIZES[size], FORMATS[fmt][0])
+            write_file(path, thumbnail)
+            self.grow(len(thumbnail))
+        return path
+
+    def resize(self, source, size, image_format):
+        """
+        Crops and scales an image to fill size, like "object-fit: cover",
+        and returns it encoded in image_format.
+        """
+
+        if Image is None:
+            raise ImageError("Pillow is not installed")
+        try:
+            with Image.open(source) as image:
+                image = ImageOps.exif_transpose(image).convert("RGB")
+                image = ImageOps.fit(image, size, Image.LANCZOS)
+                output = io.BytesIO()
+                image.save(output, image_format, quality=self.quality)
+                return output.getvalue()
+        except (OSError, ValueError, Image.DecompressionBombError) as error:
+            raise ImageError("Could not resize {}: {}".format(source, error))
+
+    def files(self):
+        for folder in ("sources", "variants"):
+            with os.scandir(os.path.join(self.directory, folder)) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        yield entry
+
+    def grow(self, added):
+        """
+        Adds to the size of the cache, evicting images if it is too large.
+        The size is counted from disk on the first call and on every
+        eviction, as other workers share the directory.
+        """
+
+        with self.lock:
+            if self.size is None:
+                self.size = sum(entry.stat().st_size for entry in self.files())
+            else:
+                self.size += added
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used files until the cache is under 90%
+        of max_bytes. Thumbnails are touched each time they are served.
+        """
+
+        entries = sorted(
+            ((entry.stat().st_mtime, entry.stat().st_size, entry.path)
+             for entry in self.files()), reverse=True)
+        self.size = sum(size for _, size, _ in entries)
+        while entries and self.size > self.max_bytes * 0.9:
+            _, size, path = entries.pop()
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+
+    def picture(self, url, size, alt="", css_class="", default=None,
+                lazy=True):
+        """
+        Returns a <picture> tag for an image, with WebP and JPEG thumbnails
+        for browsers to choose from. Images that can't be resized (no Pillow,
+        or not an http(s) URL) are linked directly, and default is used if
+        there is no url.
+        """
+
+        url = url or default or ""
+        attributes = 'src="{}" class="{}" alt="{}"'.format(
+            escape(url), escape(css_class), escape(alt))
+        if lazy:
+            attributes += ' loading="lazy"'
+        if not self.enabled or not url.startswith(("http://", "https://")):
+            return Markup("<img {}>".format(attributes))
+
+        token = self.token(url)
+        webp = url_for("image", token=token, size=size, fmt="webp")
+        jpeg = url_for("image", token=token, size=size, fmt="jpeg")
+        attributes = attributes.replace(
+            'src="{}"'.format(escape(url)), 'src="{}"'.format(jpeg), 1)
+        return Markup(
+            '<picture><source srcset="{}" type="image/webp">'
+            '<img {}></picture>'.format(webp, attributes))
+
+    def init_app(self, app):
+        self.serializer = URLSafeSerializer(app.secret_key, salt="images")
+        app.jinja_env.globals["picture"] = self.picture
@@ -0,0 +1,115 @@
+"""This program declares the MongoDB indexes the app relies on.
+
+Every query app.py makes is listed in QUERY_SHAPES, and the indexes that
+support them are listed in INDEXES. ensure_indexes() is called when the app
+starts to create any missing indexes, and unindexed_queries() reports any
+query shape that has no supporting index so that a new query added to
+app.py without an index is noticed.
+
+The indexes can also be created and checked from the command line with:
+
+    python indexes.py
+"""
+
+
+import os
+
+from pymongo import ASCENDING, DESCENDING, IndexModel, MongoClient
+from pymongo.errors import OperationFailure
+
+from search import ensure_text_index, TEXT_INDEX_WEIGHTS
+
+
+# Indexes for each collection, unique where the app expects one document.
+# subscriber_email_unique is what stops an email subscribing twice.
+INDEXES = {
+    "users": [
+        IndexModel([("username", ASCENDING)], unique=True,
+                   name="username_unique"),
+        IndexModel([("email", ASCENDING)], unique=True,
+                   name="email_unique"),
+        IndexModel([("saved_recipes", ASCENDING)], name="saved_recipes"),
+    ],
+    "recipes": [
+        IndexModel([("meal_name", ASCENDING), ("_id", ASCENDING)],
+                   name="meal_name_id"),
+        IndexModel([("created_by", ASCENDING), ("_id", ASCENDING)],
+                   name="created_by_id"),
+        IndexModel([("saved_count", DESCENDING), ("_id", DESCENDING)],
+                   name="saved_count_id"),
+    ],
+    "subscribers": [
+        IndexModel([("subscriber_email", ASCENDING)], unique=True,
+                   name="subscriber_email_unique"),
+    ],
+}
+
+# Fields each query in app.py filters on, by collection
+QUERY_SHAPES = {
+    "users": [("username",), ("email",), ("saved_recipes",)],
+    "recipes": [("_id",), ("meal_name",), ("created_by",), ("saved_count",),
+                tuple(TEXT_INDEX_WEIGHTS)],
+}
+
+
+def ensure_indexes(db):
+    """
+    Creates any missing indexes and returns a list of the ones that could
+    not be created, for example a unique index on a collection that already
+    has duplicate values.
+    """
+
+    failed = []
+    for collection, indexes in INDEXES.items():
+        for index in indexes:
+            try:
+                db[collection].create_indexes([index])
+            except OperationFailure as error:
+                failed.append("{}.{}: {}".format(
+                    collection, index.document["name"], error))
+    try:
+        ensure_text_index(db.recipes)
+    except OperationFailure as error:
+        failed.append("recipes.text: {}".format(error))
+    return failed
+
+
+def index_fields(index):
+    """
+    Returns the fields an index covers, in order.
+    Text indexes are returned as the fields they search.
+    """
+
+    if "weights" in index:
+        return tuple(index["weights"])
+    return tuple(field for field, _ in index["key"])
+
+
+def unindexed_queries(db):
+    """
+    Returns the query shapes from QUERY_SHAPES that are not the leading
+    fields of any index on their collection.
+    """
+
+    missing = []
+    for collection, shapes in QUERY_SHAPES.items():
+        indexed = [index_fields(index) for index in
+                   db[collection].index_information().values()]
+        for shape in shapes:
+            if not any(set(fields[:len(shape)]) == set(shape)
+                       for fields in indexed):
+                missing.append("{}: {}".format(collection, ", ".join(shape)))
+    return missing
+
+
+if __name__ == "__main__":
+    if os.path.exists("env.py"):
+        import env  # noqa: F401
+
+    db = MongoClient(os.environ.get("MONGO_URI")).get_database(
+        os.environ.get("MONGO_DBNAME"))
+    for problem in ensure_indexes(db):
+        print("Could not create index", problem)
+    for shape in unindexed_queries(db):
+        print("No index for query on", shape)
+    print("Index check complete")
@@ -0,0 +1,220 @@
+"""This program includes the rate limits for the routes that are expensive
+or easy to abuse: login, register, search and subscribe.
+
+Each limited route has a budget, such as "20/minute", for each client IP
+address and, for login and register, for each username. Budgets are token
+buckets: a client can use its whole budget at once, and then gets it back
+steadily over the period. Once a bucket is empty the route returns a 429
+(too many requests) error before doing any work.
+
+Buckets are kept in each worker's memory, or in Redis if
+RATE_LIMIT_REDIS_URL is set, so that every worker shares the same budgets.
+Budgets can be changed with RATE_LIMITS, for example
+"login:ip=30/minute,search:ip=60/minute".
+
+Expensive routes (password hashing and searches) also have a cap on how
+many can run at once in each worker. If the cap is reached the route
+returns a 503 (busy) error straight away instead of waiting, so a burst of
+logins or searches can't hold up every thread.
+"""
+
+
+import math
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import request, session
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+
+
+# Budgets for each route and key, see parse_budget()
+DEFAULT_BUDGETS = {
+    "login:ip": "20/minute",
+    "login:username": "10/minute",
+    "register:ip": "5/minute",
+    "search:ip": "30/minute",
+    "subscribe:ip": "5/minute",
+}
+
+PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+
+
+def parse_budget(budget):
+    """
+    Returns the size and refill rate (tokens per second) of a bucket from a
+    budget such as "10/minute".
+    """
+
+    count, period = budget.strip().split("/")
+    count = int(count)
+    return count, count / PERIODS[period.strip()]
+
+
+def parse_budgets(budgets):
+    """
+    Returns DEFAULT_BUDGETS updated with the budgets in a string such as
+    "login:ip=30/minute,search:ip=60/minute".
+    """
+
+    parsed = dict(DEFAULT_BUDGETS)
+    for item in (budgets or "").split(","):
+        if item.strip():
+            name, budget = item.split("=")
+            parsed[name.strip()] = budget.strip()
+    return {name: parse_budget(budget) for name, budget in parsed.items()}
+
+
+class MemoryBuckets:
+    """
+    Token buckets kept in memory, separately in each worker process.
+    Holds at most max_size buckets, dropping the least recently used, which
+    are the ones most likely to be full again anyway.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, size, rate):
+        """
+        Takes a token from the bucket for key. Returns 0 if there was one,
+        or the number of seconds until there will be.
+        """
+
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (size, now))
+            tokens = min(size, tokens + (now - updated) * rate)
+            if tokens >= 1:
+                tokens, wait = tokens - 1, 0
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_size:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+class RedisBuckets:
+    """
+    Token buckets stored in Redis and shared by every worker process.
+    Each take is one script run in Redis, so it is atomic.
+    Needs the redis package, which is only imported when this is used.
+    """
+
+    SCRIPT = """
+    local size = tonumber(ARGV[1])
+    local rate = tonumber(ARGV[2])
+    local now = tonumber(ARGV[3])
+    local bucket = redis.call("HMGET", KEYS[1], "tokens", "updated")
+    local tokens = tonumber(bucket[1]) or size
+    local updated = tonumber(bucket[2]) or now
+    tokens = math.min(size, tokens + math.max(0, now - updated) * rate)
+    local wait = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+    else
+        wait = (1 - tokens) / rate
+    end
+    redis.call("HMSET", KEYS[1], "tokens", tokens, "updated", now)
+    redis.call("EXPIRE", KEYS[1], math.ceil(size / rate) + 1)
+    return tostring(wait)
+    """
+
+    def __init__(self, url, prefix="eating-vegan:limit:"):
+        import redis
+
+        self._redis = redis.Redis.from_url(url)
+        self._take = self._redis.register_script(self.SCRIPT)
+        self.prefix = prefix
+
+    def take(self, key, size, rate):
+        return float(self._take(
+            keys=[self.prefix + key], args=[size, rate, time.time()]))
+
+
+def make_buckets(config):
+    """
+    Returns Redis buckets if RATE_LIMIT_REDIS_URL is set, otherwise
+    in memory buckets.
+    """
+
+    if config.get("RATE_LIMIT_REDIS_URL"):
+        return RedisBuckets(config["RATE_LIMIT_REDIS_URL"])
+    return MemoryBuckets()
+
+
+class RateLimiter:
+    """
+    Decorates routes with rate limits and the cap on expensive requests.
+    """
+
+    def __init__(self, buckets, budgets, max_expensive=8, enabled=True):
+        self.buckets = buckets
+        self.budgets = budgets
+        self.enabled = enabled
+        self.expensive = threading.BoundedSemaphore(max_expensive)
+        self.limited = 0
+        self.shed = 0
+
+    @staticmethod
+    def client_key(kind):
+        """
+        Returns who a request is from: its IP address, or the username in
+        the form (or the logged in user). Returns None if there is none.
+        """
+
+        if kind == "ip":
+            return request.remote_addr
+        username = request.form.get("username") or session.get("user")
+        return username and username.lower()
+
+    def check(self, route):
+        """
+        Takes a token from each of the route's buckets for this request.
+        Raises TooManyRequests if any of them is empty.
+        """
+
+        for name, (size, rate) in self.budgets.items():
+            limited_route, kind = name.split(":")
+            key = limited_route == route and self.client_key(kind)
+            if not key:
+                continue
+            wait = self.buckets.take(
+                "{}:{}".format(name, key), size, rate)
+            if wait:
+                self.limited += 1
+                raise TooManyRequests(
+                    "Too many requests, please try again in {} seconds"
+                    .format(math.ceil(wait)), retry_after=math.ceil(wait))
+
+    def limit(self, route, methods=("POST",), expensive=False):
+        """
+        Decorator applying the route's budgets to requests with one of
+        methods. Expensive routes also count towards the cap on expensive
+        requests running at once.
+        """
+
+        def decorator(f):
+            @wraps(f)
+            def limited(*args, **kwargs):
+                if not self.enabled or request.method not in methods:
+                    return f(*args, **kwargs)
+                self.check(route)
+                if not expensive:
+                    return f(*args, **kwargs)
+                if not self.expensive.acquire(blocking=False):
+                    self.shed += 1
+                    raise ServiceUnavailable(
+                        "Sorry, we're very busy right now. "
+                        "Please try again in a moment", retry_after=1)
+                try:
+                    return f(*args, **kwargs)
+                finally:
+                    self.expensive.release()
+            return limited
+        return decorator
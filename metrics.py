@@ -0,0 +1,161 @@
+"""This program includes the request performance metrics.
+
+Every request is timed, and a PyMongo command listener counts the MongoDB
+commands each request sends and how long they take. Requests slower than
+SLOW_REQUEST_MS are logged along with their MongoDB command count, which
+makes N+1 query patterns easy to spot. The totals are kept per route
+(Flask endpoint name) and served in the Prometheus text format by the
+/metrics route in app.py.
+
+Metrics are kept per process, so under gunicorn each worker reports its own.
+"""
+
+
+import threading
+import time
+
+from flask import g, request
+from pymongo import monitoring
+
+
+# Upper bounds in seconds of the request duration histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """
+    Counts the MongoDB commands sent, and the time they took, by the request
+    running on the current thread. Commands sent outside a request (for
+    example from background threads) aren't counted.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def start_request(self):
+        self._local.commands = 0
+        self._local.seconds = 0.0
+
+    def end_request(self):
+        commands = getattr(self._local, "commands", 0)
+        seconds = getattr(self._local, "seconds", 0.0)
+        self._local.__dict__.clear()
+        return commands, seconds
+
+    def started(self, event):
+        if hasattr(self._local, "commands"):
+            self._local.commands += 1
+
+    def succeeded(self, event):
+        if hasattr(self._local, "seconds"):
+            self._local.seconds += event.duration_micros / 1e6
+
+    def failed(self, event):
+        self.succeeded(event)
+
+
+class RequestMetrics:
+    """
+    Collects request duration histograms and MongoDB command totals per
+    endpoint, and logs slow requests.
+    """
+
+    def __init__(self, slow_ms=500, logger=None):
+        self.slow_ms = slow_ms
+        self.logger = logger
+        self.listener = MongoCommandListener()
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def init_app(self, app):
+        app.before_request(self._start)
+        app.teardown_request(self._finish)
+
+    def _start(self):
+        g.request_started = time.perf_counter()
+        self.listener.start_request()
+
+    def _finish(self, error=None):
+        if "request_started" not in g:
+            return
+        duration = time.perf_counter() - g.request_started
+        commands, mongo_seconds = self.listener.end_request()
+        endpoint = request.endpoint or "unknown"
+        self.record(endpoint, duration, commands, mongo_seconds)
+
+        if self.logger and duration * 1000 > self.slow_ms:
+            self.logger.warning(
+                "Slow request %s %s (%s): %.0fms, %d MongoDB commands "
+                "taking %.0fms", request.method, request.path, endpoint,
+                duration * 1000, commands, mongo_seconds * 1000)
+
+    def record(self, endpoint, duration, commands, mongo_seconds):
+        with self._lock:
+            stats = self._endpoints.setdefault(endpoint, {
+                "buckets": [0] * len(BUCKETS), "count": 0, "sum": 0.0,
+                "commands": 0, "mongo_seconds": 0.0, "slow": 0})
+            for index, bound in enumerate(BUCKETS):
+                if duration <= bound:
+                    stats["buckets"][index] += 1
+            stats["count"] += 1
+            stats["sum"] += duration
+            stats["commands"] += commands
+            stats["mongo_seconds"] += mongo_seconds
+            if duration * 1000 > self.slow_ms:
+                stats["slow"] += 1
+
+    def totals(self, endpoint):
+        """
+        Returns the number of requests and MongoDB commands recorded so far
+        for endpoint.
+        """
+
+        with self._lock:
+            stats = self._endpoints.get(endpoint, {})
+            return stats.get("count", 0), stats.get("commands", 0)
+
+    def render(self, counters=None):
+        """
+        Returns all metrics in the Prometheus text format. counters is an
+        optional dict of extra counter names and values to include.
+        """
+
+        with self._lock:
+            endpoints = {name: dict(stats, buckets=list(stats["buckets"]))
+                         for name, stats in sorted(self._endpoints.items())}
+
+        lines = [
+            "# HELP request_duration_seconds Time taken to handle requests.",
+            "# TYPE request_duration_seconds histogram",
+        ]
+        for name, stats in endpoints.items():
+            for bound, count in zip(BUCKETS, stats["buckets"]):
+                lines.append(
+                    'request_duration_seconds_bucket{{endpoint="{}",'
+                    'le="{}"}} {}'.format(name, bound, count))
+            lines.append(
+                'request_duration_seconds_bucket{{endpoint="{}",'
+                'le="+Inf"}} {}'.format(name, stats["count"]))
+            lines.append('request_duration_seconds_sum{{endpoint="{}"}} {}'
+                         .format(name, stats["sum"]))
+            lines.append('request_duration_seconds_count{{endpoint="{}"}} {}'
+                         .format(name, stats["count"]))
+
+        for metric, key, help_text in (
+                ("mongo_commands_total", "commands",
+                 "MongoDB commands sent while handling requests."),
+                ("mongo_command_seconds_total", "mongo_seconds",
+                 "Time spent waiting on MongoDB commands."),
+                ("slow_requests_total", "slow",
+                 "Requests slower than the slow request threshold.")):
+            lines.append("# HELP {} {}".format(metric, help_text))
+            lines.append("# TYPE {} counter".format(metric))
+            for name, stats in endpoints.items():
+                lines.append('{}{{endpoint="{}"}} {}'.format(
+                    metric, name, stats[key]))
+
+        for metric, value in (counters or {}).items():
+            lines.append("# TYPE {} counter".format(metric))
+            lines.append("{} {}".format(metric, value))
+
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,121 @@
+"""This program includes the helpers used to page through recipe listings.
+
+Recipe listings are paged on the recipe "_id" (keyset pagination) rather than
+by skipping documents, so every page costs the same to fetch no matter how far
+through the collection a user has browsed. Listing pages only load the fields
+that are shown on a recipe card, leaving out the long ingredients and method.
+
+The profile page fetches the user and a page of their recipes, with the
+number of recipes in total, in one aggregation (see user_with_recipes()).
+When the total is already known, from the recipe summary, it isn't counted.
+"""
+
+
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+
+
+# Fields shown on the recipe cards in recipes.html, and the recipe version
+# used for the page's ETag
+CARD_FIELDS = {
+    "recipe_name": 1,
+    "meal_name": 1,
+    "description": 1,
+    "img_url": 1,
+    "created_by": 1,
+    "version": 1,
+    "updated_at": 1,
+}
+
+# Fields shown on the recipe cards in profile.html
+PROFILE_CARD_FIELDS = dict(
+    CARD_FIELDS, date_created=1, active_time=1, total_time=1, **{"yield": 1})
+
+# Fields of a user shown on their profile page
+PROFILE_USER_FIELDS = {
+    "username": 1,
+    "date_joined": 1,
+    "profile_image": 1,
+}
+
+
+def parse_cursor(after):
+    """
+    Returns the ObjectId a page should start after.
+    Returns None if no cursor was passed or it is not a valid ObjectId.
+    """
+
+    if not after:
+        return None
+    try:
+        return ObjectId(after)
+    except (InvalidId, TypeError):
+        return None
+
+
+def keyset_page(collection, query, after=None, per_page=12,
+                projection=CARD_FIELDS):
+    """
+    Returns a page of documents matching query, sorted by "_id", along with
+    the cursor for the next page (None if this is the last page).
+    One extra document is fetched to check if there is a next page.
+    """
+
+    if after is not None:
+        query = dict(query, _id={"$gt": after})
+
+    page = list(collection.find(query, projection)
+                .sort("_id", 1)
+                .limit(per_page + 1))
+
+    next_after = None
+    if len(page) > per_page:
+        page = page[:per_page]
+        next_after = str(page[-1]["_id"])
+
+    return page, next_after
+
+
+def user_with_recipes(users, recipes, username, query, after=None,
+                      per_page=12, total=None):
+    """
+    Returns the profile fields of a user, a page of the recipes matching
+    query (paged on "_id" like keyset_page()), the cursor for the next
+    page and the number of recipes matching query, from one aggregation.
+    Returns None for the user if they don't exist.
+
+    Each $lookup starts with a $match on query, so the page and the count
+    are both read from the recipe indexes. If total is passed the recipes
+    aren't counted and total is returned instead.
+    """
+
+    page_query = dict(query, _id={"$gt": after}) if after else query
+    count = [] if total is not None else [
+        {"$lookup": {"from": recipes.name, "as": "total", "pipeline": [
+            {"$match": query},
+            {"$count": "count"},
+        ]}},
+    ]
+    result = list(users.aggregate([
+        {"$match": {"username": username}},
+        {"$project": PROFILE_USER_FIELDS},
+        {"$lookup": {"from": recipes.name, "as": "recipes", "pipeline": [
+            {"$match": page_query},
+            {"$sort": {"_id": 1}},
+            {"$limit": per_page + 1},
+            {"$project": PROFILE_CARD_FIELDS},
+        ]}},
+    ] + count))
+    if not result:
+        return None, [], None, 0
+
+    user = result[0]
+    page = user.pop("recipes")
+    if total is None:
+        counted = user.pop("total")
+        total = counted[0]["count"] if counted else 0
+    next_after = None
+    if len(page) > per_page:
+        page = page[:per_page]
+        next_after = str(page[-1]["_id"])
+    return user, page, next_after, total
@@ -0,0 +1,100 @@
+"""This program keeps count of how many users have saved each recipe.
+
+Each recipe has a saved_count, increased when a user saves it and decreased
+when they remove it (see set_saved() in app.py), so the most saved recipes
+can be read from the saved_count index instead of counting every user's
+saved_recipes array. The popular recipes are shown on the home page and
+the recipes page.
+
+The counts are only changed when a user's saved recipes actually change, so
+they stay right, but a failed write or a deleted user can leave them out
+by a little. They can be rebuilt from the users collection with:
+
+    python popular.py
+"""
+
+
+import os
+
+from pymongo import DESCENDING, MongoClient, UpdateOne
+
+from pagination import CARD_FIELDS
+
+
+# Number of popular recipes shown
+POPULAR_SIZE = 6
+
+
+def change_count(recipes, recipe_id, change):
+    """
+    Adds change (1 or -1) to a recipe's saved_count. Counts never go below
+    zero.
+    """
+
+    query = {"_id": recipe_id}
+    if change < 0:
+        query["saved_count"] = {"$gte": -change}
+    recipes.update_one(query, {"$inc": {"saved_count": change}})
+
+
+def change_counts(recipes, recipe_ids, change):
+    """
+    Adds change to the saved_count of every recipe in recipe_ids at once,
+    used when a user who saved them is deleted.
+    """
+
+    if not recipe_ids:
+        return
+    query = {"_id": {"$in": list(recipe_ids)}}
+    if change < 0:
+        query["saved_count"] = {"$gte": -change}
+    recipes.update_many(query, {"$inc": {"saved_count": change}})
+
+
+def get_popular(recipes, limit=POPULAR_SIZE):
+    """
+    Returns the cards of the most saved recipes, most saved first. Recipes
+    no one has saved aren't included.
+    """
+
+    return list(recipes.find(
+        {"saved_count": {"$gt": 0}}, dict(CARD_FIELDS, saved_count=1))
+        .sort([("saved_count", DESCENDING), ("_id", DESCENDING)])
+        .limit(limit))
+
+
+def reconcile(users, recipes, batch_size=1000):
+    """
+    Rebuilds every recipe's saved_count from the users' saved_recipes
+    arrays. Only counts that are wrong are written. Returns the number of
+    recipes changed.
+    """
+
+    counts = {result["_id"]: result["count"] for result in users.aggregate([
+        {"$unwind": "$saved_recipes"},
+        {"$group": {"_id": "$saved_recipes", "count": {"$sum": 1}}},
+    ])}
+
+    updates = []
+    for recipe in recipes.find(
+            {"$or": [{"_id": {"$in": list(counts)}},
+                     {"saved_count": {"$ne": 0, "$exists": True}}]},
+            {"saved_count": 1}):
+        count = counts.get(recipe["_id"], 0)
+        if recipe.get("saved_count") != count:
+            updates.append(UpdateOne(
+                {"_id": recipe["_id"]}, {"$set": {"saved_count": count}}))
+
+    for start in range(0, len(updates), batch_size):
+        recipes.bulk_write(updates[start:start + batch_size], ordered=False)
+    return len(updates)
+
+
+if __name__ == "__main__":
+    if os.path.exists("env.py"):
+        import env  # noqa: F401
+
+    db = MongoClient(os.environ.get("MONGO_URI")).get_database(
+        os.environ.get("MONGO_DBNAME"))
+    changed = reconcile(db.users, db.recipes)
+    print("Saved counts fixed for {} recipes".format(changed))
@@ -0,0 +1,323 @@
+"""This program imports and exports recipes in bulk.
+
+Files are either newline delimited JSON (one recipe per line, .ndjson or
+.jsonl) or CSV with a header row of field names. Recipes are read and
+written one batch at a time, so files of any size can be imported or
+exported without loading them into memory:
+
+    python recipe_transfer.py export recipes.ndjson
+    python recipe_transfer.py import recipes.ndjson --user admin
+
+Imported recipes are checked with the same rules as the add recipe form and
+tidied the same way, then written in batches. Invalid recipes are skipped and
+reported with their line number. Recipes with an "_id" (such as those in an
+export) replace the recipe with that id, so a backup can be imported again.
+
+Progress is saved to a checkpoint file after each batch. If an import stops
+part way, running it again with --resume carries on after the last batch
+written. Recipes without an "_id" are given one made from the start time of
+the import and their line number, so a resumed import never adds a recipe
+twice. The recipe summary is rebuilt when an import finishes.
+"""
+
+
+import argparse
+import csv
+import hashlib
+import json
+import os
+import struct
+import sys
+import time
+from datetime import date, datetime
+from itertools import islice
+
+from bson import json_util
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from pymongo import MongoClient, UpdateOne
+
+from summary import rebuild
+from validation import (
+    RECIPE_RULES, Rule, Rules, normalise_recipe, validate_many)
+
+
+# Fields of a recipe, in the order they are exported to CSV
+EXPORT_FIELDS = [
+    "_id", "recipe_name", "meal_name", "description", "ingredients", "method",
+    "recommendation", "yield", "active_time", "total_time", "img_url",
+    "created_by", "date_created",
+]
+
+# Fields the add recipe form requires
+REQUIRED_FIELDS = [
+    "recipe_name", "meal_name", "description", "ingredients", "method",
+    "yield", "active_time", "total_time",
+]
+
+MEAL_NAMES = ("Breakfast", "Lunch", "Dinner", "Desserts")
+
+# The add recipe form's rules, with the checks the form itself makes
+IMPORT_RULES = Rules({
+    field: ((Rule("required", None, "Missing {}".format(field)),)
+            if field in REQUIRED_FIELDS else ())
+    + ((Rule("one_of", MEAL_NAMES, "Unknown meal"),)
+       if field == "meal_name" else ())
+    + RECIPE_RULES.get(field, ())
+    for field in REQUIRED_FIELDS + ["recommendation"]
+})
+
+
+def file_format(path, fmt=None):
+    """
+    Returns "csv" or "ndjson", from fmt if given or else the file extension.
+    """
+
+    fmt = fmt or ("csv" if path.lower().endswith(".csv") else "ndjson")
+    if fmt not in ("csv", "ndjson"):
+        raise ValueError("Unknown format {}".format(fmt))
+    return fmt
+
+
+def read_records(file, fmt):
+    """
+    Yields the line number and record for each recipe in file. The record
+    is None if the line can't be read.
+    """
+
+    if fmt == "csv":
+        reader = csv.DictReader(file)
+        for record in reader:
+            yield reader.line_num, record
+        return
+
+    for number, line in enumerate(file, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json_util.loads(line)
+        except ValueError:
+            record = None
+        yield number, record if isinstance(record, dict) else None
+
+
+def import_id(started, source, number):
+    """
+    Returns the "_id" for the recipe on line number of an import started at
+    started. Ids keep the order of the file and are the same every time the
+    import is resumed.
+    """
+
+    return ObjectId(struct.pack(">I", int(started))
+                    + hashlib.md5(source.encode()).digest()[:3]
+                    + number.to_bytes(5, "big"))
+
+
+def chunks(items, size):
+    """
+    Yields lists of up to size items from items.
+    """
+
+    items = iter(items)
+    chunk = list(islice(items, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(items, size))
+
+
+def prepare_many(records, created_by, today):
+    """
+    Returns (recipe, error) for each record, see prepare(). The records are
+    checked together with validate_many().
+    """
+
+    errors = validate_many(
+        [record or {} for record in records], IMPORT_RULES)
+    return [prepare(record, record_errors, created_by, today)
+            for record, record_errors in zip(records, errors)]
+
+
+def prepare(record, errors, created_by, today):
+    """
+    Returns an imported record as a recipe ready to save and None, or None
+    and the reason the record is invalid. errors are the record's errors
+    from validate_many().
+    """
+
+    if record is None:
+        return None, "Could not read recipe"
+    if errors:
+        return None, "; ".join(message for _, message in errors)
+
+    recipe = normalise_recipe(
+        {field: str(record.get(field) or "") for field in EXPORT_FIELDS[1:]})
+    recipe["created_by"] = recipe["created_by"] or created_by
+    recipe["date_created"] = recipe["date_created"] or today
+    if record.get("_id"):
+        try:
+            recipe["_id"] = ObjectId(record["_id"])
+        except (InvalidId, TypeError):
+            return None, "Invalid _id {}".format(record["_id"])
+    return recipe, None
+
+
+def write_batch(collection, recipes):
+    """
+    Saves a batch of recipes in one bulk write. Each recipe replaces the
+    fields of any recipe with the same "_id", and its version is increased
+    so cached copies of the old recipe aren't used.
+    """
+
+    now = datetime.utcnow()
+    collection.bulk_write([UpdateOne(
+        {"_id": recipe["_id"]},
+        {"$set": dict({field: value for field, value in recipe.items()
+                       if field != "_id"}, updated_at=now),
+         "$inc": {"version": 1}},
+        upsert=True) for recipe in recipes], ordered=False)
+
+
+def load_checkpoint(path, source):
+    """
+    Returns the checkpoint saved for source, or None if there isn't one.
+    """
+
+    try:
+        with open(path) as file:
+            checkpoint = json.load(file)
+    except FileNotFoundError:
+        return None
+    return checkpoint if checkpoint.get("source") == source else None
+
+
+def save_checkpoint(path, checkpoint):
+    with open(path + ".tmp", "w") as file:
+        json.dump(checkpoint, file)
+    os.replace(path + ".tmp", path)
+
+
+def import_recipes(db, path, fmt=None, created_by="admin", batch_size=1000,
+                   checkpoint_path=None, resume=False, progress=None):
+    """
+    Imports the recipes in the file at path and returns the number written
+    and the number skipped as invalid.
+    """
+
+    source = os.path.abspath(path)
+    checkpoint_path = checkpoint_path or path + ".checkpoint"
+    checkpoint = resume and load_checkpoint(checkpoint_path, source)
+    if not checkpoint:
+        checkpoint = {"source": source, "started": time.time(),
+                      "line": 0, "written": 0, "skipped": 0}
+    today = date.today().strftime("%d/%m/%Y")
+    progress = progress or (lambda message: None)
+    start = time.perf_counter()
+    written_before = checkpoint["written"]
+
+    def flush(batch, line):
+        if batch:
+            write_batch(db.recipes, batch)
+        checkpoint.update(line=line, written=checkpoint["written"] +
+                          len(batch))
+        save_checkpoint(checkpoint_path, checkpoint)
+        rate = (checkpoint["written"] - written_before) / max(
+            time.perf_counter() - start, 1e-9)
+        progress("Line {}: {} written, {} skipped ({:.0f} recipes/s)".format(
+            line, checkpoint["written"], checkpoint["skipped"], rate))
+
+    line = checkpoint["line"]
+    with open(path, newline="", encoding="utf-8") as file:
+        records = ((line, record) for line, record
+                   in read_records(file, file_format(path, fmt))
+                   if line > checkpoint["line"])
+        for chunk in chunks(records, batch_size):
+            batch = []
+            prepared = prepare_many(
+                [record for _, record in chunk], created_by, today)
+            for (line, _), (recipe, error) in zip(chunk, prepared):
+                if error:
+                    checkpoint["skipped"] += 1
+                    progress("Line {} skipped: {}".format(line, error))
+                    continue
+                recipe.setdefault(
+                    "_id", import_id(checkpoint["started"], source, line))
+                batch.append(recipe)
+            flush(batch, line)
+
+    rebuild(db.recipes, db.recipe_summary)
+    try:
+        os.remove(checkpoint_path)
+    except FileNotFoundError:
+        pass
+    return checkpoint["written"], checkpoint["skipped"]
+
+
+def export_recipes(db, file, fmt, batch_size=1000):
+    """
+    Writes every recipe to file, oldest first, and returns the number
+    written.
+    """
+
+    if fmt == "csv":
+        writer = csv.DictWriter(file, EXPORT_FIELDS, extrasaction="ignore")
+        writer.writeheader()
+
+    count = 0
+    for recipe in db.recipes.find({}, batch_size=batch_size).sort("_id", 1):
+        if fmt == "csv":
+            writer.writerow(dict(recipe, _id=str(recipe["_id"])))
+        else:
+            file.write(json_util.dumps(
+                recipe, json_options=json_util.RELAXED_JSON_OPTIONS) + "\n")
+        count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    importer = commands.add_parser("import", help="import recipes from file")
+    importer.add_argument("path")
+    importer.add_argument("--user", default="admin",
+                          help="created_by for recipes that don't have one")
+    importer.add_argument("--batch-size", type=int, default=1000)
+    importer.add_argument("--checkpoint",
+                          help="checkpoint file (default <path>.checkpoint)")
+    importer.add_argument("--resume", action="store_true",
+                          help="carry on from the checkpoint")
+
+    exporter = commands.add_parser("export", help="export recipes to file")
+    exporter.add_argument("path", help="file to write, - for stdout")
+    exporter.add_argument("--batch-size", type=int, default=1000)
+
+    for command in (importer, exporter):
+        command.add_argument("--format", choices=["ndjson", "csv"])
+    args = parser.parse_args()
+
+    if os.path.exists("env.py"):
+        import env  # noqa: F401
+
+    db = MongoClient(os.environ.get("MONGO_URI")).get_database(
+        os.environ.get("MONGO_DBNAME"))
+
+    if args.command == "import":
+        written, skipped = import_recipes(
+            db, args.path, fmt=args.format, created_by=args.user,
+            batch_size=args.batch_size, checkpoint_path=args.checkpoint,
+            resume=args.resume,
+            progress=lambda message: print(message, file=sys.stderr))
+        print("Imported {} recipes, skipped {}".format(written, skipped))
+        return
+
+    fmt = file_format(args.path, args.format)
+    if args.path == "-":
+        count = export_recipes(db, sys.stdout, fmt, args.batch_size)
+    else:
+        with open(args.path, "w", newline="", encoding="utf-8") as file:
+            count = export_recipes(db, file, fmt, args.batch_size)
+    print("Exported {} recipes".format(count), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
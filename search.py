@@ -0,0 +1,69 @@
+"""This program includes the recipe search functions.
+
+Recipes are searched using a MongoDB text index over the recipe name,
+ingredients and description. Matches in the recipe name count the most
+towards a result's score, then ingredients, then description. Results are
+sorted by score and paged, and the total number of matches is fetched in the
+same aggregation as the page of results.
+"""
+
+
+from pymongo import TEXT
+
+from pagination import CARD_FIELDS
+
+
+TEXT_INDEX_NAME = "recipe_text_search"
+
+TEXT_INDEX_WEIGHTS = {
+    "recipe_name": 10,
+    "ingredients": 5,
+    "description": 1,
+}
+
+
+def ensure_text_index(collection):
+    """
+    Creates the weighted text index on recipes.
+    A collection can only have one text index, so any other text index
+    (for example one created by hand in Atlas) is dropped first.
+    """
+
+    for name, index in collection.index_information().items():
+        is_text = any(kind == "text" for _, kind in index["key"])
+        if is_text and (name != TEXT_INDEX_NAME or
+                        index.get("weights") != TEXT_INDEX_WEIGHTS):
+            collection.drop_index(name)
+
+    collection.create_index(
+        [(field, TEXT) for field in TEXT_INDEX_WEIGHTS],
+        weights=TEXT_INDEX_WEIGHTS, name=TEXT_INDEX_NAME)
+
+
+def search_recipes(collection, query, meal_name=None, page=1, per_page=12):
+    """
+    Returns a page of recipes matching the search query, best matches first,
+    along with the total number of matches.
+    If meal_name is given only recipes for that meal are searched.
+    """
+
+    match = {"$text": {"$search": query}}
+    if meal_name:
+        match["meal_name"] = meal_name
+
+    results = list(collection.aggregate([
+        {"$match": match},
+        {"$sort": {"score": {"$meta": "textScore"}, "_id": 1}},
+        {"$facet": {
+            "total": [{"$count": "count"}],
+            "recipes": [
+                {"$skip": (page - 1) * per_page},
+                {"$limit": per_page},
+                {"$project": CARD_FIELDS},
+            ],
+        }},
+    ]))
+
+    facets = results[0] if results else {"total": [], "recipes": []}
+    total = facets["total"][0]["count"] if facets["total"] else 0
+    return facets["recipes"], total
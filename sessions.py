@@ -0,0 +1,303 @@
+"""This program includes the server-side session store.
+
+Flask keeps sessions in a signed cookie, so every logged in route has to
+load the user from MongoDB again. With a session store the cookie holds
+only a random session id, and the session itself is kept on the server: in
+Redis if SESSION_REDIS_URL is set (shared by every dyno), or with
+SESSION_STORE set to "file" in files in SESSION_DIR (shared by the workers
+on one dyno only) or "memory" (one worker only, for development). Without
+one of these the signed cookie is still used, as sessions in a local store
+would be lost whenever a dyno restarts or a request goes to another dyno.
+
+A stored session is only written when it changes. Otherwise its expiry is
+just pushed back, which is much cheaper than writing it again.
+
+Each session also keeps a small snapshot of the logged in user (see
+UserSnapshots), so routes can read the user from the session instead of
+MongoDB. Every user has a version number in the store, and any write to a
+user document bumps it, which makes every snapshot of that user out of date
+at once, in every session and every worker. Snapshots need a session
+store, so with cookie sessions the user is loaded on every request.
+"""
+
+
+import hashlib
+import logging
+import os
+import random
+import secrets
+import time
+
+import bson
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+from cache import MISSING, MemoryBackend, RedisBackend
+
+
+# Fields of a user kept in their session snapshot. Changing them changes
+# SNAPSHOT_VERSION, so snapshots with the old fields are reloaded.
+SNAPSHOT_FIELDS = (
+    "username", "email", "date_joined", "profile_image", "saved_recipes")
+SNAPSHOT_VERSION = hashlib.md5(",".join(SNAPSHOT_FIELDS).encode()).hexdigest()
+
+
+class FileBackend:
+    """
+    Store kept in files in a local directory, so every worker process on
+    the same machine sees the same sessions. Values are stored as BSON, one
+    file per key, and written to a temporary file first so a reader never
+    sees half a file. Expired files are removed now and again as sessions
+    are saved.
+    """
+
+    def __init__(self, directory, sweep_every=500):
+        self.directory = directory
+        self.sweep_every = sweep_every
+        for folder in ("values", "versions"):
+            os.makedirs(os.path.join(directory, folder), exist_ok=True)
+
+    def _path(self, folder, key):
+        return os.path.join(self.directory, folder,
+                            hashlib.sha1(key.encode()).hexdigest())
+
+    def get(self, key):
+        path = self._path("values", key)
+        try:
+            with open(path, "rb") as file:
+                item = bson.decode(file.read())
+            expired = os.path.getmtime(path) + item["ttl"] < time.time()
+        except (FileNotFoundError, bson.errors.BSONError):
+            return MISSING
+        if expired:
+            self.delete(key)
+            return MISSING
+        return item["value"]
+
+    def set(self, key, value, ttl):
+        path = self._path("values", key)
+        temporary = "{}.{}.tmp".format(path, secrets.token_hex(4))
+        with open(temporary, "wb") as file:
+            file.write(bson.encode({"value": value, "ttl": ttl}))
+        os.replace(temporary, path)
+        if random.randrange(self.sweep_every) == 0:
+            self.sweep()
+
+    def touch(self, key, ttl):
+        """
+        Pushes back the expiry of key. A value expires ttl seconds after
+        its file was last modified, so this only updates the file's time.
+        """
+
+        try:
+            os.utime(self._path("values", key))
+        except FileNotFoundError:
+            pass
+
+    def delete(self, *keys):
+        for key in keys:
+            try:
+                os.remove(self._path("values", key))
+            except FileNotFoundError:
+                pass
+
+    def version(self, namespace):
+        """
+        Versions are the length of a file that bump() adds a byte to.
+        Appends are atomic, so bumps from different workers are never lost.
+        """
+
+        try:
+            return os.path.getsize(self._path("versions", namespace))
+        except FileNotFoundError:
+            return 0
+
+    def bump(self, namespace):
+        with open(self._path("versions", namespace), "ab") as file:
+            file.write(b".")
+
+    def sweep(self):
+        """
+        Removes expired values, and temporary files left by a worker that
+        stopped part way through a write.
+        """
+
+        folder = os.path.join(self.directory, "values")
+        now = time.time()
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            try:
+                if name.endswith(".tmp"):
+                    if os.path.getmtime(path) < now - 60:
+                        os.remove(path)
+                    continue
+                with open(path, "rb") as file:
+                    ttl = bson.decode(file.read())["ttl"]
+                if os.path.getmtime(path) + ttl < now:
+                    os.remove(path)
+            except (OSError, bson.errors.BSONError):
+                continue
+
+
+def make_store(config, logger=None):
+    """
+    Returns a Redis store if SESSION_REDIS_URL is set, an in memory store
+    if SESSION_STORE is "memory", a file store in SESSION_DIR if it is
+    "file", or else None for signed cookie sessions.
+    """
+
+    if config.get("SESSION_REDIS_URL"):
+        return RedisBackend(
+            config["SESSION_REDIS_URL"], prefix="eating-vegan:session:")
+    store = config.get("SESSION_STORE")
+    if store in ("file", "memory") and os.environ.get("DYNO"):
+        (logger or logging.getLogger(__name__)).warning(
+            "SESSION_STORE=%s keeps sessions on this dyno only, so users "
+            "are logged out when it restarts. Use SESSION_REDIS_URL if "
+            "there is more than one dyno.", store)
+    if store == "memory":
+        return MemoryBackend(max_size=100000)
+    if store == "file":
+        return FileBackend(config["SESSION_DIR"])
+    return None
+
+
+def regenerate(session):
+    """
+    Moves a stored session to a new id. Cookie sessions have no id, so are
+    left as they are.
+    """
+
+    if isinstance(session, ServerSession):
+        session.regenerate()
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    """
+    A session kept in the store under sid. Any change marks it modified so
+    it is saved at the end of the request.
+    """
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid or secrets.token_urlsafe(32)
+        self.new = new
+        self.modified = False
+        self.old_sid = None
+
+    def regenerate(self):
+        """
+        Moves the session to a new id, so an id seen before login can't be
+        used to reach the logged in session.
+        """
+
+        self.old_sid = self.old_sid or self.sid
+        self.sid = secrets.token_urlsafe(32)
+        self.modified = True
+
+
+class ServerSessionInterface(SessionInterface):
+    """
+    Stores sessions in a store from make_store(), with only the session id
+    in the cookie.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    @staticmethod
+    def key(sid):
+        return "session:{}".format(sid)
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.session_cookie_name)
+        if sid:
+            data = self.store.get(self.key(sid))
+            if data is not MISSING:
+                return ServerSession(data, sid=sid)
+        return ServerSession(new=True)
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.old_sid:
+            self.store.delete(self.key(session.old_sid))
+
+        if not session:
+            if session.modified and not session.new:
+                self.store.delete(self.key(session.sid))
+                response.delete_cookie(
+                    app.session_cookie_name, domain=domain, path=path)
+            return
+
+        if session.accessed:
+            response.vary.add("Cookie")
+        if not self.should_set_cookie(app, session):
+            return
+
+        ttl = int(app.permanent_session_lifetime.total_seconds())
+        if session.modified or session.new:
+            self.store.set(self.key(session.sid), dict(session), ttl)
+        else:
+            self.store.touch(self.key(session.sid), ttl)
+        response.set_cookie(
+            app.session_cookie_name, session.sid,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app))
+
+
+class UserSnapshots:
+    """
+    Keeps a snapshot of the logged in user in their session. With no
+    store (cookie sessions) there are no snapshots and load() is called
+    every time.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    @staticmethod
+    def namespace(username):
+        return "user:{}".format(username)
+
+    def get(self, session, username, load):
+        """
+        Returns the snapshot of username in session if it is current,
+        otherwise calls load() for the user document and keeps a snapshot
+        of it. The version is read before load(), so a write made while
+        the user is loading leaves the snapshot out of date, not stale.
+        """
+
+        if self.store is None:
+            user = load()
+            return user and {field: user.get(field)
+                             for field in SNAPSHOT_FIELDS}
+
+        version = self.store.version(self.namespace(username))
+        snapshot = session.get("_user")
+        if (snapshot and snapshot["username"] == username
+                and snapshot["version"] == version
+                and snapshot["fields"] == SNAPSHOT_VERSION):
+            return snapshot["user"]
+
+        user = load()
+        if user is None:
+            return None
+        user = {field: user.get(field) for field in SNAPSHOT_FIELDS}
+        session["_user"] = {"username": username, "version": version,
+                            "fields": SNAPSHOT_VERSION, "user": user}
+        return user
+
+    def invalidate(self, username):
+        """
+        Marks every snapshot of username out of date. Called after every
+        write to a user document.
+        """
+
+        if self.store is not None:
+            self.store.bump(self.namespace(username))
@@ -59,3 +59,33 @@ $(function(){
 $("#subscribe").submit(function(){
   alert("Thank for submitting your email.");
 });
+
+// Saves and removes saved recipes without reloading the page.
+// Falls back to a normal form post if the response isn't JSON (e.g. logged out).
+
+function toggleSaved(form, onDone) {
+  $.ajax({
+    url: form.action,
+    method: "POST",
+    headers: { Accept: "application/json" },
+    dataType: "json"
+  }).done(onDone).fail(function(){
+    form.submit();
+  });
+}
+
+$(".save-form").submit(function(event){
+  event.preventDefault();
+  const button = $(this).find("button");
+  toggleSaved(this, function(data){
+    button.html(data.changed ? '<i class="fas fa-heart"></i> Saved!' : '<i class="fas fa-heart"></i> Already Saved');
+  });
+});
+
+$(".remove-saved-form").submit(function(event){
+  event.preventDefault();
+  const card = $(this).closest(".col-12");
+  toggleSaved(this, function(){
+    card.slideUp();
+  });
+});
@@ -0,0 +1,185 @@
+"""This program keeps a summary of the recipes collection up to date.
+
+The summary is a single document in the recipe_summary collection holding
+the number of recipes, the number of recipes for each meal and for each
+user, and the newest recipes (card fields only). The recipe write functions
+in app.py update it as recipes are added, edited, deleted or handed over
+to admin, so listing pages can read one small document instead of counting
+recipes on every request.
+
+The summary can be rebuilt from the recipes collection with:
+
+    python summary.py
+"""
+
+
+import os
+
+from pymongo import MongoClient, ReturnDocument
+
+from pagination import CARD_FIELDS
+
+
+SUMMARY_ID = "recipes"
+
+# Number of newest recipes kept in the summary
+NEWEST_SIZE = 6
+
+
+def count_key(name):
+    """
+    Returns name in a form that can be used as a field name in an update,
+    as "." and a leading "$" can't be used in MongoDB field paths.
+    """
+
+    return name.replace(".", "．").replace("$", "＄")
+
+
+def card(recipe):
+    """
+    Returns only the card fields of a recipe.
+    """
+
+    return {field: recipe.get(field) for field in ("_id", *CARD_FIELDS)}
+
+
+def get_summary(collection):
+    """
+    Returns the summary document, or an empty summary if it doesn't exist.
+    Counts are returned keyed by the original meal and user names.
+    """
+
+    summary = collection.find_one({"_id": SUMMARY_ID}) or {}
+    return {
+        "total": summary.get("total", 0),
+        "meal_counts": summary.get("meal_counts", {}),
+        "creator_counts": {
+            name.replace("．", ".").replace("＄", "$"): count
+            for name, count in summary.get("creator_counts", {}).items()},
+        "newest": summary.get("newest", []),
+    }
+
+
+def record_added(collection, recipe):
+    """
+    Adds a new recipe to the counts and the front of the newest recipes.
+    """
+
+    collection.update_one(
+        {"_id": SUMMARY_ID},
+        {"$inc": {
+            "total": 1,
+            "meal_counts." + count_key(recipe["meal_name"]): 1,
+            "creator_counts." + count_key(recipe["created_by"]): 1,
+        }, "$push": {"newest": {
+            "$each": [card(recipe)], "$position": 0, "$slice": NEWEST_SIZE,
+        }}},
+        upsert=True)
+
+
+def record_edited(collection, old, new):
+    """
+    Moves an edited recipe between meal counts if its meal changed and
+    updates its card if it is one of the newest recipes.
+    """
+
+    update = {"$set": {
+        "newest.$[recipe].{}".format(field): new.get(field)
+        for field in CARD_FIELDS if field in new},
+        "$inc": {"newest.$[recipe].version": 1}}
+    if old["meal_name"] != new["meal_name"]:
+        update["$inc"].update({
+            "meal_counts." + count_key(old["meal_name"]): -1,
+            "meal_counts." + count_key(new["meal_name"]): 1,
+        })
+    collection.update_one(
+        {"_id": SUMMARY_ID}, update,
+        array_filters=[{"recipe._id": old["_id"]}])
+
+
+def newest_cards(recipes):
+    """
+    Returns the cards of the newest recipes, newest first.
+    """
+
+    return list(recipes.find({}, CARD_FIELDS)
+                .sort("_id", -1).limit(NEWEST_SIZE))
+
+
+def record_removed(collection, recipe, recipes):
+    """
+    Removes a deleted recipe from the counts and the newest recipes. If it
+    was one of the newest recipes, they are read again from recipes (after
+    the recipe has been deleted) so the list stays full.
+    """
+
+    before = collection.find_one_and_update(
+        {"_id": SUMMARY_ID},
+        {"$inc": {
+            "total": -1,
+            "meal_counts." + count_key(recipe["meal_name"]): -1,
+            "creator_counts." + count_key(recipe["created_by"]): -1,
+        }, "$pull": {"newest": {"_id": recipe["_id"]}}},
+        projection={"newest._id": 1},
+        return_document=ReturnDocument.BEFORE)
+    if before and any(card["_id"] == recipe["_id"]
+                      for card in before.get("newest", [])):
+        collection.update_one(
+            {"_id": SUMMARY_ID}, {"$set": {"newest": newest_cards(recipes)}})
+
+
+def record_reassigned(collection, from_user, to_user, count):
+    """
+    Moves count recipes from one user to another, used when a deleted
+    user's recipes are handed over to admin.
+    """
+
+    if not count:
+        return
+    collection.update_one(
+        {"_id": SUMMARY_ID},
+        {"$inc": {
+            "creator_counts." + count_key(from_user): -count,
+            "creator_counts." + count_key(to_user): count,
+            "newest.$[recipe].version": 1,
+        }, "$set": {"newest.$[recipe].created_by": to_user}},
+        array_filters=[{"recipe.created_by": from_user}])
+
+
+def rebuild(recipes, collection):
+    """
+    Rebuilds the summary from the recipes collection in one aggregation.
+    """
+
+    result = list(recipes.aggregate([{"$facet": {
+        "total": [{"$count": "count"}],
+        "meals": [{"$group": {"_id": "$meal_name", "count": {"$sum": 1}}}],
+        "creators": [
+            {"$group": {"_id": "$created_by", "count": {"$sum": 1}}}],
+        "newest": [
+            {"$sort": {"_id": -1}},
+            {"$limit": NEWEST_SIZE},
+            {"$project": CARD_FIELDS},
+        ],
+    }}]))[0]
+
+    summary = {
+        "total": result["total"][0]["count"] if result["total"] else 0,
+        "meal_counts": {count_key(meal["_id"]): meal["count"]
+                        for meal in result["meals"] if meal["_id"]},
+        "creator_counts": {count_key(user["_id"]): user["count"]
+                           for user in result["creators"] if user["_id"]},
+        "newest": result["newest"],
+    }
+    collection.replace_one({"_id": SUMMARY_ID}, summary, upsert=True)
+    return summary
+
+
+if __name__ == "__main__":
+    if os.path.exists("env.py"):
+        import env  # noqa: F401
+
+    db = MongoClient(os.environ.get("MONGO_URI")).get_database(
+        os.environ.get("MONGO_DBNAME"))
+    summary = rebuild(db.recipes, db.recipe_summary)
+    print("Summary rebuilt for {} recipes".format(summary["total"]))
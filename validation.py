@@ -5,33 +5,330 @@ In this programm I have included the decorator to check a user is logged
 in to be called on different routes in the app.py file. This programme also
 includes validation functions for users that are registering an account,
 adding a recipe or updating their password.
+
+The rules for each form are written out as data (see the *_RULES below)
+and checked by validate(), which doesn't need a request, so the same rules
+can check recipes being imported or sent to the API. validate() returns
+every rule a record breaks, and validate_many() checks a list of records in
+one call. The valid_*() functions used by the forms flash the first error,
+as they always have, found by first_errors(), which stops at it.
 """
 
 
+import string
+from collections import namedtuple
 from flask import (
-    Flask, flash, request, session, redirect, url_for)
+    Flask, flash, request, session, redirect, url_for, jsonify)
 from functools import wraps
 
 
 def login_required(f):
     """
     Decorator to be called on views that require users to be logged in.
+    JSON API requests get a 401 error instead of being sent to login.
     """
 
     @wraps(f)
     def login_check(*args, **kwargs):
         if 'user' not in session:
+            if request.blueprint == "api":
+                return jsonify(error="You need to login first!"), 401
             flash("You need to login first!")
             return redirect(url_for('login'))
         return f(*args, **kwargs)
     return login_check
 
 
+# Validation rules #
+
+# A rule a field must pass. kind is one of:
+#   "required"    the field must not be empty
+#   "min_length"  the field must have at least limit characters
+#   "max_length"  the field must have at most limit characters
+#   "one_of"      the field must be one of the values in limit
+#   "has"         the field must have a character of class limit
+Rule = namedtuple("Rule", ["kind", "limit", "message"])
+
+SYMBOLS = "!@#$%^&*"
+
+# The code char_classes() gives each class of character. Codes are ints,
+# as looking for an int in bytes is much quicker than looking for bytes.
+CLASS_CODES = {"lower": ord("l"), "upper": ord("u"), "digit": ord("d"),
+               "symbol": ord("s")}
+
+# Table for bytes.translate() that turns each ASCII character into the code
+# of its class, or a space if it isn't in one
+ASCII_CLASSES = bytes(
+    ord("l") if chr(byte) in string.ascii_lowercase
+    else ord("u") if chr(byte) in string.ascii_uppercase
+    else ord("d") if chr(byte) in string.digits
+    else ord("s") if chr(byte) in SYMBOLS
+    else ord(" ") for byte in range(256))
+
+
+def char_classes(value):
+    """
+    Returns the codes (see CLASS_CODES) of the classes of the characters in
+    value as bytes, so CLASS_CODES["lower"] in char_classes(value) if it
+    has a lowercase letter. ASCII strings, which nearly every password
+    is, are translated in one call instead of looking at each character in
+    Python.
+    """
+
+    if value.isascii():
+        return value.encode().translate(ASCII_CLASSES)
+
+    codes = bytearray()
+    for char in set(value):
+        if char.islower():
+            codes += b"l"
+        elif char.isupper():
+            codes += b"u"
+        elif char.isdigit():
+            codes += b"d"
+        elif char in SYMBOLS:
+            codes += b"s"
+    return bytes(codes)
+
+
+def text(value):
+    """
+    Returns value as a string, with None as an empty string.
+    """
+
+    if value.__class__ is str:
+        return value
+    return "" if value is None else str(value)
+
+
+# The test each kind of rule makes, as Python code for Rules.compile(), where
+# {value} is the value, {limit} the rule's limit and {classes} the value's
+# character classes
+RULE_TESTS = {
+    "required": "{value}.strip()",
+    "min_length": "len({value}) >= {limit}",
+    "max_length": "len({value}) <= {limit}",
+    "one_of": "{value} in {limit}",
+    "has": "{limit} in {classes}",
+}
+
+
+class ErrorSets(dict):
+    """
+    The errors of each combination of broken rules, keyed by a number with
+    a bit set for each broken rule. Each combination is only made once, the
+    first time it is needed.
+    """
+
+    def __init__(self, errors):
+        super().__init__({0: ()})
+        self.errors = errors
+
+    def __missing__(self, broken):
+        errors = self[broken] = tuple(
+            error for bit, error in enumerate(self.errors)
+            if broken >> bit & 1)
+        return errors
+
+
+class Rules(dict):
+    """
+    The rules for a form, as a mapping of field names to a tuple of Rule.
+
+    When the Rules is made its rules are compiled into functions that check
+    a list of records (see compile()), so checking a record costs no more
+    than the hand written checks the forms used to make.
+    """
+
+    def __init__(self, fields):
+        super().__init__(fields)
+        self.check_many, self.first_errors = self.compile()
+
+    def compile(self):
+        """
+        Returns two functions that take a list of records: one returns
+        every error for each record, like validate_many(), and the other
+        the first error or None, like first_errors().
+
+        Each function is one list comprehension with every rule written out
+        as a test, and the field names, limits and errors as literals, so a
+        record is checked without a single function call. Values are read
+        with record[field] + "", which fails if a field is missing or isn't
+        a string. Then the records are checked again by a slower version
+        that reads values with text(record.get(field)).
+        """
+
+        errors = []
+        functions = []
+        for read in ("{record}[{field!r}] + ''",
+                     "text({record}.get({field!r}))"):
+            tests = []
+            for number, (field, rules) in enumerate(self.items()):
+                value = "v{}".format(number)
+                classes = "c{}".format(number)
+                # The value and its classes are found by the first test
+                # that needs them, and kept if a later test needs them too.
+                # Tests are always made in order, so later tests can use
+                # them.
+                first_value = read.format(record="record", field=field)
+                if len(rules) > 1:
+                    first_value = "{} := {}".format(value, first_value)
+                first_value = "({})".format(first_value)
+                first_classes = "char_classes({value})"
+                if sum(rule.kind == "has" for rule in rules) > 1:
+                    first_classes = "({} := {})".format(
+                        classes, first_classes)
+                for rule in rules:
+                    if rule.kind not in RULE_TESTS:
+                        raise ValueError("Unknown rule {}".format(rule.kind))
+                    if rule.kind == "has":
+                        limit = CLASS_CODES[rule.limit]
+                    elif rule.kind == "one_of":
+                        limit = tuple(rule.limit)
+                    else:
+                        limit = rule.limit
+                    tests.append(RULE_TESTS[rule.kind].format(
+                        value=first_value, limit=repr(limit),
+                        classes=first_classes.format(value=first_value)))
+                    first_value = value
+                    if rule.kind == "has":
+                        first_classes = classes
+                    if len(errors) < len(tests):
+                        errors.append((field, rule.message))
+
+            tests = ["({})".format(test) for test in tests]
+            broken = " | ".join(
+                "(not {}) << {}".format(test, bit)
+                for bit, test in enumerate(tests)) or "0"
+            functions.append(ALL_ERRORS_SOURCE.format(
+                tests=" and ".join(tests) or "True",
+                broken=broken.replace(" << 0", "")))
+            functions.append(FIRST_ERROR_SOURCE.format(tests="".join(
+                "{!r} if not {} else ".format(errors[bit], test)
+                for bit, test in enumerate(tests))))
+
+        namespace = {"text": text, "char_classes": char_classes,
+                     "error_sets": ErrorSets(errors)}
+        exec(compile(RULES_SOURCE.format(*functions), "<rules>", "exec"),
+             namespace)
+        return namespace["check_many"], namespace["first_errors"]
+
+
+# The expressions Rules.compile() writes for each record. Valid records
+# share the empty tuple, so nothing is made for them.
+ALL_ERRORS_SOURCE = "() if {tests} else error_sets[{broken}]"
+FIRST_ERROR_SOURCE = "{tests}None"
+
+# The functions Rules.compile() writes
+RULES_SOURCE = """
+def check_many(records):
+    try:
+        return [{0} for record in records]
+    except (KeyError, TypeError):
+        return [{2} for record in records]
+
+
+def first_errors(records):
+    try:
+        return [{1} for record in records]
+    except (KeyError, TypeError):
+        return [{3} for record in records]
+"""
+
+
+PASSWORD_RULES = (
+    Rule("min_length", 5, "Password must be at least 5 characters."),
+    Rule("max_length", 15, "Password should not exceed 15 characters."),
+    Rule("has", "lower",
+         "Password should have at least one lowercase letter."),
+    Rule("has", "upper",
+         "Password should have at least one uppercase letter."),
+    Rule("has", "digit", "Password should have at least one number."),
+    Rule("has", "symbol",
+         "Password should include at least one symbol: !@#$%^&* "),
+)
+
+USERNAME_RULES = (
+    Rule("min_length", 5, "Username must be at least 5 characters."),
+    Rule("max_length", 15, "Username cant be longer than 15 characters."),
+)
+
+REGISTRATION_RULES = Rules({
+    "password": PASSWORD_RULES,
+    "username": USERNAME_RULES,
+})
+
+PASSWORD_UPDATE_RULES = Rules({
+    "new-password": PASSWORD_RULES,
+    "confirm-password": PASSWORD_RULES,
+})
+
+RECIPE_RULES = Rules({
+    "description": (Rule(
+        "max_length", 100,
+        "Whoops! 😔 Description can't be longer than 100 characters"),),
+    "recipe_name": (Rule(
+        "max_length", 35,
+        "Whoops! 😔 Recipe name can't be longer than 35 characters"),),
+    "recommendation": (Rule(
+        "max_length", 100,
+        "Whoops! 😔 Recommendation can't be longer than 100 characters"),),
+})
+
+
+def validate_many(records, rules):
+    """
+    Checks each record (any mapping of field names to values) in records
+    against a Rules. Returns a list with a tuple of (field, message) for
+    every rule each record breaks, in the order of rules. Missing fields
+    are checked as empty strings and other values as strings.
+    """
+
+    return rules.check_many(records)
+
+
+def validate(record, rules):
+    """
+    Checks one record against a Rules, see validate_many().
+    """
+
+    return rules.check_many([record])[0]
+
+
+def first_errors(records, rules):
+    """
+    Returns the (field, message) of the first rule each record in records
+    breaks, or None if it breaks none. Rules after the first broken one
+    aren't checked, so this is quicker than validate_many() when only one
+    error is shown, as on the forms.
+    """
+
+    return rules.first_errors(records)
+
+
+# Form validation #
+
+def valid_form(record, rules):
+    """
+    Flashes the first error in record and returns False, or returns True
+    if there are no errors.
+    """
+
+    error = rules.first_errors([record])[0]
+    if error:
+        flash(error[1])
+        return False
+    return True
+
+
+PASSWORD_FORM_RULES = Rules({"password": PASSWORD_RULES})
+
+USERNAME_FORM_RULES = Rules({"username": USERNAME_RULES})
+
+
 def password_check(password):
     """
-    Code adjusted from
-    https://stackoverflow.com/questions/41117733/validation-of-a-password-python.
-    This function checks the following:
+    Checks a password against PASSWORD_RULES:
 
     If password length is greater than 5 and less than 15
     If password has at least one uppercase letter
@@ -39,40 +336,16 @@ def password_check(password):
     If password has at least one number
     If password has any of the required special symbols
     """
-    symbols = ['!', '@', '#', '$', '%', '^', '&', '*']
 
-    if len(password) < 5:
-        flash('Password must be at least 5 characters.')
-        return False
-    if len(password) > 15:
-        flash('Password should not exceed 15 characters.')
-        return False
-    if not any(char.islower() for char in password):
-        flash('Password should have at least one lowercase letter.')
-        return False
-    if not any(char.isupper() for char in password):
-        flash('Password should have at least one uppercase letter.')
-        return False
-    if not any(char.isdigit() for char in password):
-        flash('Password should have at least one number.')
-        return False
-    if not any(char in symbols for char in password):
-        flash('Password should include at least one symbol: !@#$%^&* ')
-        return False
-    return True
+    return valid_form({"password": password}, PASSWORD_FORM_RULES)
 
 
 def username_check(username):
     """
     This function checks if username length is greater than 5 and less than 15.
     """
-    if len(username) < 5:
-        flash('Username must be at least 5 characters.')
-        return False
-    if len(username) > 15:
-        flash('Username cant be longer than 15 characters.')
-        return False
-    return True
+
+    return valid_form({"username": username}, USERNAME_FORM_RULES)
 
 
 def valid_registration():
@@ -80,10 +353,22 @@ def valid_registration():
     This function checks both username and password for a valid registration.
     """
 
-    password = request.form.get("password")
-    username = request.form.get("username")
+    return valid_form(request.form, REGISTRATION_RULES)
+
+
+def normalise_recipe(recipe):
+    """
+    Returns a copy of a new recipe with its description and recommendation
+    capitalised and "mins" written as "minutes" in its times.
+    """
 
-    return password_check(password) and username_check(username)
+    recipe = dict(recipe)
+    for field in ("description", "recommendation"):
+        recipe[field] = (recipe.get(field) or "").capitalize()
+    for field in ("active_time", "total_time"):
+        recipe[field] = (recipe.get(field) or "").replace(
+            "mins", "minutes").title()
+    return recipe
 
 
 def valid_recipe():
@@ -95,20 +380,11 @@ def valid_recipe():
     That recommendations is no longer than 100 characters,
     """
 
-    description = request.form.get("description")
-    recipe_name = request.form.get("recipe_name")
-    recommendations = request.form.get("recos")
-
-    if len(description) > 100:
-        flash("Whoops! 😔 Description can't be longer than 100 characters")
-        return False
-    elif len(recipe_name) > 35:
-        flash("Whoops! 😔 Recipe name can't be longer than 35 characters")
-        return False
-    elif len(recommendations) > 100:
-        flash("Whoops! 😔 Recommendation can't be longer than 100 characters")
-        return False
-    return True
+    return valid_form({
+        "description": request.form.get("description"),
+        "recipe_name": request.form.get("recipe_name"),
+        "recommendation": request.form.get("recos"),
+    }, RECIPE_RULES)
 
 
 def valid_password_update():
@@ -116,7 +392,4 @@ def valid_password_update():
     This function checks that the two new passwords meet the password criteria
     """
 
-    new_password = request.form.get('new-password')
-    confirm_password = request.form.get("confirm-password")
-
-    return password_check(new_password) and password_check(confirm_password)
+    return valid_form(request.form, PASSWORD_UPDATE_RULES)
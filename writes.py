@@ -0,0 +1,143 @@
+"""This program includes the write-behind queue for writes that don't need
+to happen before a response is sent, such as newsletter subscriptions.
+
+Routes put a write (a pymongo InsertOne, UpdateOne and so on) on the queue
+and return straight away. A background thread in each worker writes
+everything queued every flush interval, with one unordered bulk_write per
+collection, so a spike of thousands of subscriptions becomes a handful of
+writes to MongoDB. Inserts that break a unique index (for example an email
+that is already subscribed) are skipped, which replaces checking for the
+document before inserting it.
+
+The queue holds at most max_size writes. If it is full a write is made
+straight away on the request thread instead, so nothing is dropped. Any
+writes still queued are made when the worker shuts down.
+"""
+
+
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+
+from pymongo.errors import BulkWriteError, PyMongoError
+
+
+# Error code MongoDB gives writes that break a unique index
+DUPLICATE_KEY = 11000
+
+
+class WriteQueue:
+    """
+    Queues writes and makes them in batches from a background thread.
+    With interval set to 0 every write is made straight away.
+    """
+
+    def __init__(self, interval=1.0, max_size=10000, batch_size=1000,
+                 logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.interval = interval
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.queued = 0
+        self.written = 0
+        self.batches = 0
+        self.failed = 0
+        self.overflowed = 0
+        self._pending = []
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        atexit.register(self.flush)
+
+    def put(self, collection, operation):
+        """
+        Queues operation (for example InsertOne(document)) to be written to
+        collection with the next batch.
+        """
+
+        if not self.interval:
+            self._write(collection, [operation])
+            return
+        with self._lock:
+            full = len(self._pending) >= self.max_size
+            if not full:
+                self._pending.append((collection, operation))
+                self.queued += 1
+                self._start()
+        if full:
+            self.overflowed += 1
+            self._write(collection, [operation])
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _start(self):
+        """
+        Starts the flush thread in the current process if it isn't running.
+        Threads don't survive a fork, so each gunicorn worker starts its own.
+        Must be called with the lock held.
+        """
+
+        if self._thread is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        """
+        Writes everything queued so far, one bulk write per collection.
+        """
+
+        with self._lock:
+            pending, self._pending = self._pending, []
+        collections = {}
+        by_collection = defaultdict(list)
+        for collection, operation in pending:
+            collections[collection.full_name] = collection
+            by_collection[collection.full_name].append(operation)
+        for name, operations in by_collection.items():
+            collection = collections[name]
+            for start in range(0, len(operations), self.batch_size):
+                self._write(
+                    collection, operations[start:start + self.batch_size])
+
+    def _write(self, collection, operations):
+        """
+        Makes operations in one unordered bulk write. Duplicate key errors
+        are expected and ignored. Other errors are logged, and the writes
+        that failed are counted and dropped.
+        """
+
+        start = time.perf_counter()
+        try:
+            collection.bulk_write(operations, ordered=False)
+            errors = []
+        except BulkWriteError as error:
+            errors = [write_error for write_error
+                      in error.details.get("writeErrors", [])
+                      if write_error.get("code") != DUPLICATE_KEY]
+        except PyMongoError as error:
+            self.failed += len(operations)
+            self.logger.error(
+                "Could not write %d queued writes to %s: %s",
+                len(operations), collection.name, error)
+            return
+
+        self.batches += 1
+        self.written += len(operations) - len(errors)
+        if errors:
+            self.failed += len(errors)
+            self.logger.error(
+                "%d queued writes to %s failed, first error: %s",
+                len(errors), collection.name, errors[0]["errmsg"])
+        self.logger.debug(
+            "Wrote %d queued writes to %s in %.1fms", len(operations),
+            collection.name, (time.perf_counter() - start) * 1000)